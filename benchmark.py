@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import itertools
+import random
+import re
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import httpx
+from src.api.server import app, set_runtime
+from src.bot.dc_bot import DiscordBot
+from src.bot.tg_bot import TelegramBot
+from src.core.forward import make_dispatcher, make_forwarders
+from src.core.routes import RouteTable
+from src.database import database, store_functions
+
+SEQ = re.compile(r"bench-(\d+)")
+TG_CHAT_ID = -100123
+DC_CHANNEL_ID = 987654
+
+
+class Recorder:
+    def __init__(self):
+        self.started = {}
+        self.returned = []
+        self.delivered = []
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def start(self, seq):
+        self.started[seq] = time.perf_counter()
+
+    def ack(self, text):
+        m = SEQ.search(text or "")
+        if not m:
+            return
+        start = self.started.pop(int(m.group(1)), None)
+        if start is not None:
+            self.delivered.append(time.perf_counter() - start)
+        if len(self.delivered) >= self.expected:
+            self.done.set()
+
+
+class FakeTelegramBot:
+    def __init__(self, recorder, latency):
+        self.recorder = recorder
+        self.latency = latency
+        self.ids = itertools.count(1_000_000)
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None):
+        await asyncio.sleep(self.latency)
+        self.recorder.ack(text)
+        return SimpleNamespace(message_id=next(self.ids))
+
+
+class FakeDiscordMessage:
+    def __init__(self, message_id, content):
+        self.id = message_id
+        self.content = content
+
+    def to_reference(self, fail_if_not_exists=True):
+        return SimpleNamespace(message_id=self.id)
+
+
+class FakeDiscordChannel:
+    def __init__(self, channel_id, recorder, latency):
+        self.id = channel_id
+        self.recorder = recorder
+        self.latency = latency
+        self.ids = itertools.count(5_000_000)
+
+    async def send(self, content, reference=None):
+        await asyncio.sleep(self.latency)
+        self.recorder.ack(content)
+        return FakeDiscordMessage(next(self.ids), content)
+
+
+class FakeDiscordClient:
+    def __init__(self, recorder, latency):
+        self.user = SimpleNamespace(id=1, bot=True)
+        self.channel = FakeDiscordChannel(DC_CHANNEL_ID, recorder, latency)
+
+    def get_channel(self, channel_id):
+        return self.channel if channel_id == self.channel.id else None
+
+    def get_partial_messageable(self, channel_id):
+        return self.get_channel(channel_id)
+
+
+def bench_config(args):
+    limit = args.rate_limits
+    return {
+        "routes": [{"name": "bench", "telegram_chat_id": TG_CHAT_ID, "discord_channel_id": DC_CHANNEL_ID}],
+        "telegram_chat_id": TG_CHAT_ID,
+        "discord_channel_id": DC_CHANNEL_ID,
+        "id_map_size": 50000,
+        "id_map_ttl": 3600,
+        "outbound_queue_size": 10000,
+        "outbound_max_retries": 3,
+        "telegram_global_rate": 30 if limit else 0,
+        "telegram_chat_rate": 1 if limit else 0,
+        "discord_channel_rate": 1 if limit else 0,
+    }
+
+
+def tg_update(seq, message_id, reply_to):
+    message = SimpleNamespace(
+        text=f"bench-{seq}",
+        chat_id=TG_CHAT_ID,
+        message_id=message_id,
+        from_user=SimpleNamespace(full_name=f"user{seq % 7}"),
+        reply_to_message=SimpleNamespace(message_id=reply_to) if reply_to else None,
+        caption=None,
+        photo=[],
+        document=None,
+        video=None,
+        animation=None,
+        audio=None,
+        voice=None,
+        video_note=None,
+        sticker=None,
+    )
+    return SimpleNamespace(message=message)
+
+
+def dc_message(seq, message_id, reply_to):
+    return SimpleNamespace(
+        id=message_id,
+        content=f"bench-{seq}",
+        author=SimpleNamespace(id=seq % 7 + 100, bot=False, display_name=f"user{seq % 7}"),
+        channel=SimpleNamespace(id=DC_CHANNEL_ID),
+        reference=SimpleNamespace(message_id=reply_to) if reply_to else None,
+        attachments=[],
+        stickers=[],
+        webhook_id=None,
+        to_reference=lambda fail_if_not_exists=True: SimpleNamespace(message_id=message_id),
+    )
+
+
+async def drive(args, recorder, tg_bot, dc_bot, http):
+    seen_tg = []
+    seen_dc = []
+    interval = 1.0 / args.rate if args.rate else 0
+    begin = time.perf_counter()
+
+    for seq in range(args.messages):
+        kind = args.source if args.source != "mixed" else random.choice(("telegram", "discord", "api"))
+        replying = random.random() < args.reply_ratio
+        recorder.start(seq)
+        t0 = time.perf_counter()
+
+        if kind == "telegram":
+            message_id = seq + 1
+            reply_to = random.choice(seen_tg) if replying and seen_tg else None
+            await tg_bot.handle_message(tg_update(seq, message_id, reply_to), None)
+            seen_tg.append(message_id)
+        elif kind == "discord":
+            message_id = 10_000_000 + seq
+            reply_to = random.choice(seen_dc) if replying and seen_dc else None
+            await dc_bot.on_message(dc_message(seq, message_id, reply_to))
+            seen_dc.append(message_id)
+        else:
+            # API messages go to both platforms; only the first ack is counted
+            await http.post("/messages", json={"text": f"bench-{seq}", "username": "bench"})
+
+        recorder.returned.append(time.perf_counter() - t0)
+        if interval:
+            await asyncio.sleep(max(0.0, begin + (seq + 1) * interval - time.perf_counter()))
+
+    return time.perf_counter() - begin
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+def report(args, recorder, sent_for, elapsed, mem_start, mem_end, mem_peak):
+    def ms(v):
+        return f"{v * 1000:.2f}ms"
+
+    print("📊 BindSync benchmark")
+    print("=" * 40)
+    print(f"   Source: {args.source}, messages: {args.messages}, target rate: {args.rate or 'max'}/s, replies: {args.reply_ratio:.0%}")
+    print(f"   Handler return  p50={ms(percentile(recorder.returned, 50))} p99={ms(percentile(recorder.returned, 99))}")
+    print(f"   End-to-end      p50={ms(percentile(recorder.delivered, 50))} p99={ms(percentile(recorder.delivered, 99))}")
+    print(f"   Delivered: {len(recorder.delivered)}/{args.messages} in {elapsed:.2f}s -> {len(recorder.delivered) / elapsed:.1f} msg/s")
+    print(f"   Inbound took {sent_for:.2f}s -> {args.messages / sent_for:.1f} msg/s accepted")
+    print(f"   Memory: {mem_start / 1024:.0f} KiB -> {mem_end / 1024:.0f} KiB (peak {mem_peak / 1024:.0f} KiB)")
+
+
+async def run(args):
+    random.seed(args.seed)
+    cfg = bench_config(args)
+    await database.init_store({"storage_backend": args.storage, "sqlite_path": args.sqlite_path})
+    routes = RouteTable.from_config(cfg)
+    await store_functions.configure(default_route=routes.default.name)
+    store_functions.start_writer(args.write_batch, 0.05)
+
+    recorder = Recorder()
+    recorder.expected = args.messages
+    tbot = SimpleNamespace(bot=FakeTelegramBot(recorder, args.platform_latency / 1000))
+    dbot = FakeDiscordClient(recorder, args.platform_latency / 1000)
+    dispatcher = make_dispatcher(cfg)
+    fwd_to_dd, forward_to_telegram = make_forwarders(tbot, dbot, dispatcher)
+
+    tg_bot = TelegramBot(routes=routes, token="bench")
+    dc_bot = DiscordBot(routes=routes)
+    dc_bot.client = dbot
+    tg_bot.set_forward_callback(fwd_to_dd)
+    dc_bot.set_forward_callback(forward_to_telegram)
+    set_runtime(tbot, dbot, cfg, routes, dispatcher)
+
+    tracemalloc.start()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    begin = time.perf_counter()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        sent_for = await drive(args, recorder, tg_bot, dc_bot, http)
+        try:
+            await asyncio.wait_for(recorder.done.wait(), timeout=args.drain_timeout)
+        except asyncio.TimeoutError:
+            print("⚠️  Not every message was delivered before the drain timeout")
+    elapsed = time.perf_counter() - begin
+    await dispatcher.close()
+    await store_functions.stop_writer()
+    await database.close_store()
+    mem_end, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    report(args, recorder, sent_for, elapsed, mem_start, mem_end, mem_peak)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive the bridge with in-process fake Telegram/Discord/Mongo backends")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="inbound messages per second, 0 for as fast as possible")
+    parser.add_argument("--reply-ratio", type=float, default=0.3)
+    parser.add_argument("--source", choices=("telegram", "discord", "api", "mixed"), default="mixed")
+    parser.add_argument("--platform-latency", type=float, default=20, help="simulated send latency in ms")
+    parser.add_argument("--write-batch", type=int, default=100)
+    parser.add_argument("--rate-limits", action="store_true", help="apply the real per-chat/global send limits")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--sqlite-path", default="bindsync_bench.db")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,8 +1,20 @@
-from fastapi import FastAPI, HTTPException, Body
+import asyncio
+import csv
+import hmac
+import io
+import json
+from fastapi import FastAPI, HTTPException, Body, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from src.core.models import MessageCreate, MessageReply
+from fastapi.responses import Response, StreamingResponse
+from telegram import Update
+from src.core.models import MessageBatch, MessageCreate, MessageReply
+from src.core.echo import echoes
+from src.core.hub import hub
+from src.core.outbox import Outbox
+from src.core.threads import nest, threads
+from src.core import fanout, metrics
 from src.database import store_functions
-from src.utils.bridge import fwd_to_tg_rply, fwd_dd_with_reply
+from src.utils.bridge import apiformat, fwd_to_tg_rply, fwd_dd_with_reply
 
 app = FastAPI(
     title="BindSync",
@@ -23,26 +35,356 @@ app.add_middleware(
 tbot = None
 dbot = None
 cfg = None
-map_tg_to_dc = None
-map_dc_to_tg = None
+routes = None
+dispatcher = None
+supervisor = None
+outbox = Outbox()
+pending_deliveries = set()
 
 
-def set_runtime(tb, db, config, tg_dc_map, dc_tg_map):
-    global tbot, dbot, cfg, map_tg_to_dc, map_dc_to_tg
+def set_runtime(tb, db, config, route_table, outbound_dispatcher, bridge_supervisor=None, delivery_outbox=None):
+    global tbot, dbot, cfg, routes, dispatcher, supervisor, outbox
     tbot = tb
     dbot = db
     cfg = config
-    map_tg_to_dc = tg_dc_map
-    map_dc_to_tg = dc_tg_map
+    routes = route_table
+    dispatcher = outbound_dispatcher
+    supervisor = bridge_supervisor
+    if delivery_outbox:
+        outbox = delivery_outbox
+
+
+def resolve_route(name=None):
+    route = routes.get(name) if routes else None
+    if not route:
+        raise HTTPException(status_code=404, detail="Route not found")
+    return route
+
+
+async def submit_api_message(route, internal_id, formatted_msg, reply_to_tg_id=None, reply_to_dc_id=None, tg=True, dc=True):
+    ids = {}
+    backfill = fanout.Backfill(lambda sent: outbox.sent_all(internal_id, sent))
+
+    def on_sent(platform):
+        # the caches learn each id as soon as it lands; the store write is merged by the back-fill
+        async def callback(dest_msg_id):
+            if not dest_msg_id:
+                return
+            ids[platform] = int(dest_msg_id)
+            threads.update(internal_id, **{store_functions.PLATFORM_ID_FIELDS[platform]: ids[platform]})
+            if "telegram" in ids and "discord" in ids:
+                route.id_map.link(ids["telegram"], ids["discord"])
+            await backfill.sent(platform, ids[platform])
+        return callback
+
+    tg_future = None
+    dc_future = None
+    if tg and tbot:
+        tg_future = await dispatcher.submit(
+            "telegram",
+            route.telegram_chat_id,
+            lambda: fwd_to_tg_rply(tbot, route.telegram_chat_id, formatted_msg, msg_id=reply_to_tg_id),
+            on_sent("telegram"),
+        )
+        # in flight as far as recovery is concerned, same as the bots' sends
+        outbox.track(internal_id, "telegram", tg_future)
+    if dc and dbot:
+        dc_future = await dispatcher.submit(
+            "discord",
+            route.discord_channel_id,
+            lambda: fwd_dd_with_reply(dbot, route.discord_channel_id, formatted_msg, message_id=reply_to_dc_id),
+            on_sent("discord"),
+        )
+        outbox.track(internal_id, "discord", dc_future)
+    return tg_future, dc_future, backfill
+
+
+def track_delivery(coro):
+    task = asyncio.ensure_future(coro)
+    pending_deliveries.add(task)
+    task.add_done_callback(pending_deliveries.discard)
+    return task
+
+
+async def settle(tg_future, dc_future, backfill):
+    results = await fanout.fan_out(
+        {"telegram": tg_future, "discord": dc_future},
+        cfg.get("fanout_timeouts") if cfg else None,
+    )
+    # everything that landed within the timeouts goes to the store in one update
+    await backfill.flush()
+    return results
+
+
+async def forward_api_message(route, internal_id, formatted_msg, reply_to_tg_id=None, reply_to_dc_id=None, tg=True, dc=True):
+    submitted = await submit_api_message(route, internal_id, formatted_msg, reply_to_tg_id, reply_to_dc_id, tg, dc)
+    return track_delivery(settle(*submitted))
+
+
+def delivery_response(internal_id, results):
+    ids = fanout.sent_ids(results)
+    return {
+        "id": internal_id,
+        "tg_msg_id": ids.get("telegram"),
+        "dc_msg_id": ids.get("discord"),
+        "queued": False,
+        "delivery": results,
+    }
+
+
+def update_processor_stats():
+    processor = getattr(tbot, "update_processor", None)
+    return processor.stats() if hasattr(processor, "stats") else None
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "runtime": {
+            "tbot_initialized": tbot is not None,
+            "dbot_initialized": dbot is not None,
+            "config_loaded": cfg is not None,
+            "maps_initialized": routes is not None,
+            "telegram_chat_id": cfg.get("telegram_chat_id") if cfg else None,
+            "discord_channel_id": cfg.get("discord_channel_id") if cfg else None,
+        },
+        "routes": [
+            {**route.as_dict(), "id_map": route.id_map.stats()} for route in routes
+        ] if routes else [],
+        "outbound": dispatcher.stats() if dispatcher else None,
+        "stream": hub.stats(),
+        "echoes": echoes.stats(),
+        "threads": threads.stats(),
+        "storage": store_functions.storage_stats(),
+        "workers": supervisor.stats() if supervisor else None,
+        "telegram_updates": update_processor_stats(),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.post("/telegram/webhook")
+async def telegram_webhook(request: Request, secret_token: str = Header(None, alias="X-Telegram-Bot-Api-Secret-Token")):
+    if not tbot or not cfg or not cfg.get("telegram_webhook_url"):
+        raise HTTPException(status_code=404, detail="Webhook mode is not enabled")
+    if not hmac.compare_digest(secret_token or "", cfg["telegram_webhook_secret"]):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    try:
+        payload = await request.json()
+        # de_json trusts its input: a non-object or a missing update_id blows up inside it
+        update = Update.de_json(payload, tbot.bot) if isinstance(payload, dict) else None
+    except (ValueError, TypeError, KeyError):
+        update = None
+    if update is None:
+        raise HTTPException(status_code=400, detail="Invalid update payload")
+    await tbot.update_queue.put(update)
+    return {"ok": True}
 
 
 @app.get("/messages")
-async def get_messages(limit: int = 100, offset: int = 0):
+async def get_messages(
+    limit: int = 100,
+    offset: int = 0,
+    after: str = None,
+    before: str = None,
+    fields: str = None,
+    source: str = None,
+    username: str = None,
+    route: str = None,
+):
     limit = max(1, min(200, limit))
     offset = max(0, offset)
-    messages = await store_functions.list_messages(limit=limit, offset=offset)
-    print(messages)
-    return {"messages": messages}
+    if after and before:
+        raise HTTPException(status_code=400, detail="Use either after or before, not both")
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        messages = await store_functions.list_messages(
+            limit=limit,
+            offset=offset,
+            after=after,
+            before=before,
+            fields=field_list,
+            source=source,
+            username=username,
+            route=route,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "messages": messages,
+        "next": store_functions.encode_cursor(messages[-1]) if len(messages) == limit else None,
+        "prev": store_functions.encode_cursor(messages[0]) if messages else None,
+    }
+
+
+@app.get("/messages/search")
+async def search_messages(
+    q: str,
+    limit: int = 50,
+    after: str = None,
+    sort: str = "relevance",
+    fields: str = None,
+    source: str = None,
+    username: str = None,
+    since: float = None,
+    until: float = None,
+    route: str = None,
+):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="q must not be empty")
+    limit = max(1, min(200, limit))
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        messages = await store_functions.search_messages(
+            q,
+            limit=limit,
+            after=after,
+            sort=sort,
+            fields=field_list,
+            source=source,
+            username=username,
+            since=since,
+            until=until,
+            route=route,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "messages": messages,
+        "next": store_functions.encode_search_cursor(messages[-1], sort) if len(messages) == limit else None,
+    }
+
+
+async def stream_messages(last_event_id=None, keepalive=15):
+    sub = hub.subscribe()
+    try:
+        last = None
+        if last_event_id:
+            start = await store_functions.get_message(last_event_id)
+            if start:
+                last = (start["timestamp"], start["id"])
+                async for m in store_functions.iter_messages(after=store_functions.encode_cursor(start)):
+                    last = (m["timestamp"], m["id"])
+                    yield m
+        while True:
+            try:
+                m = await asyncio.wait_for(sub.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield {}
+                continue
+            if m is None:
+                return
+            if last and (m["timestamp"], m["id"]) <= last:
+                continue
+            yield m
+    finally:
+        sub.close()
+
+
+@app.get("/messages/stream")
+async def stream_messages_sse(last_event_id: str = None, last_event_id_header: str = Header(None, alias="Last-Event-ID")):
+    async def events():
+        async for m in stream_messages(last_event_id or last_event_id_header):
+            if not m:
+                yield ": keepalive\n\n"
+                continue
+            yield f"id: {m['id']}\nevent: message\ndata: {json.dumps(m)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.websocket("/messages/stream")
+async def stream_messages_ws(websocket: WebSocket, last_event_id: str = None):
+    await websocket.accept()
+
+    async def send():
+        try:
+            async for m in stream_messages(last_event_id):
+                if m:
+                    await websocket.send_json(m)
+            await websocket.close(code=1013)
+        except WebSocketDisconnect:
+            pass
+
+    async def receive():
+        # clients never send anything; reading is how a disconnect between messages gets noticed
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    sender = asyncio.create_task(send())
+    reader = asyncio.create_task(receive())
+    try:
+        await asyncio.wait((sender, reader), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # cancelling the sender closes its hub subscription
+        sender.cancel()
+        reader.cancel()
+        await asyncio.gather(sender, reader, return_exceptions=True)
+    if not sender.cancelled() and sender.exception():
+        raise sender.exception()
+
+
+@app.get("/messages/export")
+async def export_messages(
+    format: str = "ndjson",
+    since: float = None,
+    until: float = None,
+    source: str = None,
+    username: str = None,
+    fields: str = None,
+    route: str = None,
+    batch_size: int = 1000,
+):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        store_functions.build_projection(field_list)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    messages = store_functions.iter_messages(
+        since=since,
+        until=until,
+        source=source,
+        username=username,
+        fields=field_list,
+        route=route,
+        batch_size=max(1, min(10000, batch_size)),
+    )
+
+    async def ndjson_rows():
+        async for m in messages:
+            yield json.dumps(m) + "\n"
+
+    async def csv_rows():
+        columns = ["id"] + (field_list or sorted(store_functions.MESSAGE_FIELDS))
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        async for m in messages:
+            writer.writerow(m)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+
+    if format == "csv":
+        return StreamingResponse(
+            csv_rows(),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=messages.csv"},
+        )
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
 
 
 @app.get("/messages/{message_id}")
@@ -53,91 +395,132 @@ async def get_message(message_id: str):
     return message
 
 
-@app.post("/messages")
-async def create_message(msg: MessageCreate):
-    msg_id = await store_functions.add_message(
-        source='api',
-        text=msg.text,
-        username=msg.username,
-        reply_to_id=msg.reply_to_id
-    )
+@app.get("/messages/{message_id}/thread")
+async def get_thread(message_id: str, depth: int = None):
+    depth = max(1, min(200, depth or threads.max_depth))
+    messages = await store_functions.get_thread(message_id, max_depth=depth)
+    if not messages:
+        raise HTTPException(status_code=404, detail="Message not found")
+    for m in messages:
+        threads.put(m)
+    return {"id": message_id, "count": len(messages), "thread": nest(messages)}
 
+
+@app.post("/messages")
+async def create_message(msg: MessageCreate, wait: bool = False):
     reply_to_tg_id = None
     reply_to_dc_id = None
+    route_name = msg.route
 
     if msg.reply_to_id:
-        orig_msg = await store_functions.get_message(msg.reply_to_id)
+        orig_msg = await threads.resolve(internal_id=msg.reply_to_id)
         if orig_msg:
             reply_to_tg_id = orig_msg.get("tg_msg_id")
             reply_to_dc_id = orig_msg.get("dc_msg_id")
+            route_name = route_name or orig_msg.get("route")
 
-    formatted_msg = f"[API] {msg.username}: {msg.text}"
+    route = resolve_route(route_name)
+    msg_id = await store_functions.add_message(
+        source='api',
+        text=msg.text,
+        username=msg.username,
+        reply_to_id=msg.reply_to_id,
+        route=route.name,
+        deliver_to=["telegram", "discord"],
+    )
+    threads.put({"id": msg_id, "route": route.name, "reply_to_id": msg.reply_to_id})
 
-    tg_msg_id = None
-    if tbot and cfg and "telegram_chat_id" in cfg:
-        tg_msg_id = await fwd_to_tg_rply(
-            tbot, cfg["telegram_chat_id"], formatted_msg,
-            msg_id=reply_to_tg_id
-        )
-        if tg_msg_id:
-            await store_functions.set_tg_msg_id(msg_id, int(tg_msg_id))
-
-    dc_msg_id = None
-    if dbot and cfg and "discord_channel_id" in cfg:
-        dc_msg_id = await fwd_dd_with_reply(
-            dbot, cfg["discord_channel_id"], formatted_msg,
-            message_id=reply_to_dc_id
+    formatted_msg = apiformat(msg.username, msg.text)
+
+    delivery = await forward_api_message(route, msg_id, formatted_msg, reply_to_tg_id, reply_to_dc_id)
+    if not wait:
+        return {"id": msg_id, "tg_msg_id": None, "dc_msg_id": None, "queued": True}
+
+    return delivery_response(msg_id, await delivery)
+
+
+@app.post("/messages/batch")
+async def create_messages(batch: MessageBatch, wait: bool = False):
+    limit = cfg.get("api_batch_max", 100) if cfg else 100
+    if not batch.messages:
+        raise HTTPException(status_code=400, detail="messages must not be empty")
+    if len(batch.messages) > limit:
+        raise HTTPException(status_code=413, detail=f"At most {limit} messages per batch")
+
+    parents = await asyncio.gather(*(
+        threads.resolve(internal_id=msg.reply_to_id) if msg.reply_to_id else asyncio.sleep(0)
+        for msg in batch.messages
+    ))
+    results = [None] * len(batch.messages)
+    accepted = []
+    for i, (msg, parent) in enumerate(zip(batch.messages, parents)):
+        route = routes.get(msg.route or (parent or {}).get("route")) if routes else None
+        if not route:
+            results[i] = {"index": i, "error": "Route not found"}
+            continue
+        accepted.append((i, msg, route, parent or {}))
+
+    ids = await store_functions.add_messages([
+        {
+            "source": "api",
+            "text": msg.text,
+            "username": msg.username,
+            "reply_to_id": msg.reply_to_id,
+            "route": route.name,
+            "deliver_to": ["telegram", "discord"],
+        }
+        for _, msg, route, _ in accepted
+    ])
+    # submitted in request order so each destination's queue keeps it; the sends themselves overlap
+    submitted = []
+    for internal_id, (i, msg, route, parent) in zip(ids, accepted):
+        threads.put({"id": internal_id, "route": route.name, "reply_to_id": msg.reply_to_id})
+        futures = await submit_api_message(
+            route, internal_id, apiformat(msg.username, msg.text), parent.get("tg_msg_id"), parent.get("dc_msg_id"),
         )
-        if dc_msg_id:
-            await store_functions.set_dc_msg_id(msg_id, int(dc_msg_id))
+        submitted.append((i, internal_id, route, futures))
+        results[i] = {"index": i, "id": internal_id, "tg_msg_id": None, "dc_msg_id": None, "queued": True}
 
-    if tg_msg_id and dc_msg_id and map_tg_to_dc is not None and map_dc_to_tg is not None:
-        map_tg_to_dc[int(tg_msg_id)] = int(dc_msg_id)
-        map_dc_to_tg[int(dc_msg_id)] = int(tg_msg_id)
+    delivery = track_delivery(asyncio.gather(*(settle(*futures) for _, _, _, futures in submitted)))
+    if not wait:
+        return {"results": results}
 
-    return {"id": msg_id, "tg_msg_id": tg_msg_id, "dc_msg_id": dc_msg_id}
+    for (i, internal_id, _, _), item in zip(submitted, await delivery):
+        results[i] = {"index": i, **delivery_response(internal_id, item)}
+    return {"results": results}
 
 
 @app.post("/messages/{message_id}/reply")
-async def reply_to_message(message_id: str, reply: MessageReply = Body(...)):
-    orig_msg = await store_functions.get_message(message_id)
+async def reply_to_message(message_id: str, reply: MessageReply = Body(...), wait: bool = False):
+    orig_msg = await threads.resolve(internal_id=message_id)
     if not orig_msg:
         raise HTTPException(status_code=404, detail="Original message not found")
 
+    route = resolve_route(orig_msg.get("route"))
+    platforms = [p for p, field in (("telegram", "tg_msg_id"), ("discord", "dc_msg_id")) if orig_msg.get(field)]
     reply_id = await store_functions.add_message(
         source='api_reply',
         text=reply.text,
         username=reply.username,
-        reply_to_id=message_id
+        reply_to_id=message_id,
+        route=route.name,
+        deliver_to=platforms,
     )
+    threads.put({"id": reply_id, "route": route.name, "reply_to_id": message_id})
 
-    formatted_reply = f"[API] {reply.username}: {reply.text}"
-
-    tg_msg_id = None
-    dc_msg_id = None
-
-    if tbot and cfg and "telegram_chat_id" in cfg and orig_msg.get("tg_msg_id"):
-        tg_msg_id = await fwd_to_tg_rply(
-            tbot, cfg["telegram_chat_id"], formatted_reply,
-            msg_id=orig_msg.get("tg_msg_id")
-        )
-        if tg_msg_id:
-            await store_functions.set_tg_msg_id(reply_id, int(tg_msg_id))
+    formatted_reply = apiformat(reply.username, reply.text)
 
-    if dbot and cfg and "discord_channel_id" in cfg and orig_msg.get("dc_msg_id"):
-        dc_msg_id = await fwd_dd_with_reply(
-            dbot, cfg["discord_channel_id"], formatted_reply,
-            message_id=orig_msg.get("dc_msg_id")
-        )
-        if dc_msg_id:
-            await store_functions.set_dc_msg_id(reply_id, int(dc_msg_id))
-
-    if tg_msg_id and dc_msg_id and map_tg_to_dc is not None and map_dc_to_tg is not None:
-        map_tg_to_dc[int(tg_msg_id)] = int(dc_msg_id)
-        map_dc_to_tg[int(dc_msg_id)] = int(tg_msg_id)
-
-    return {"id": reply_id, "tg_msg_id": tg_msg_id, "dc_msg_id": dc_msg_id}
+    delivery = await forward_api_message(
+        route, reply_id, formatted_reply,
+        reply_to_tg_id=orig_msg.get("tg_msg_id"),
+        reply_to_dc_id=orig_msg.get("dc_msg_id"),
+        tg=bool(orig_msg.get("tg_msg_id")),
+        dc=bool(orig_msg.get("dc_msg_id")),
+    )
+    if not wait:
+        return {"id": reply_id, "tg_msg_id": None, "dc_msg_id": None, "queued": True}
 
+    return delivery_response(reply_id, await delivery)
 
 
 
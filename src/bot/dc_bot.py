@@ -1,78 +1,221 @@
+import time
 import discord
-from src.utils.bridge import istg, ddformat
+from src.utils.bridge import ddformat, forget_dc_message, remember_dc_message
+from src.core.coalesce import TELEGRAM_MESSAGE_LIMIT, Coalescer
+from src.core.debounce import Debouncer
+from src.core.echo import echoes
+from src.core.outbox import Outbox
+from src.core.threads import threads
+from src.utils.media import dc_attachments, storable
+from src.core.metrics import observe_bridge
 from src.database import store_functions
 
 class DiscordBot:
-    def __init__(self, channel_id):
-        self.channel_id = channel_id
+    def __init__(self, routes, edit_debounce=1.5, ignore_bots=False):
+        self.routes = routes
+        self.ignore_bots = ignore_bots
         self.client = None
         self.forward_to_telegram = None
-        self.map_tg_to_dc = {}
-        self.map_dc_to_tg = {}
+        self.edit_on_telegram = None
+        self.delete_on_telegram = None
+        self.handoff = None
+        self.debouncer = Debouncer(edit_debounce)
+        self.coalescer = Coalescer(ddformat, TELEGRAM_MESSAGE_LIMIT, self.send_burst, track=self.track_burst)
+        self.outbox = Outbox()
         self.intents = discord.Intents.default()
         self.intents.message_content = True
 
     def set_forward_callback(self, callback):
         self.forward_to_telegram = callback
 
-    def set_message_maps(self, tg_to_dc, dc_to_tg):
-        self.map_tg_to_dc = tg_to_dc
-        self.map_dc_to_tg = dc_to_tg
+    def set_sync_callbacks(self, edit_callback, delete_callback):
+        self.edit_on_telegram = edit_callback
+        self.delete_on_telegram = delete_callback
+
+    def set_outbox(self, outbox):
+        self.outbox = outbox
+
+    def set_handoff(self, callback):
+        self.handoff = callback
 
     async def on_ready(self):
-       if self.client.get_channel(self.channel_id):
-           print("Connected to Discord channel")
-       else :
-           print("Discord: channel not found")
+        for route in self.routes:
+            if self.client.get_channel(route.discord_channel_id):
+                print(f"Connected to Discord channel for route {route.name}")
+            else:
+                print(f"Discord: channel not found for route {route.name}")
+
+    def is_echo(self, channel_id, message_id, author_id, bot=False):
+        # our own posts, including ones a shard worker sent with the same token
+        if self.client.user and str(author_id) == str(self.client.user.id):
+            return True
+        if echoes.seen("discord", channel_id, message_id):
+            return True
+        return self.ignore_bots and bot
 
     async def on_message(self, message):
-        if message.author == self.client.user:
+        if self.is_echo(message.channel.id, message.id, message.author.id, message.author.bot or message.webhook_id is not None):
+            return
+        route = self.routes.for_dc(message.channel.id)
+        if not route:
+            return
+        attachments = dc_attachments(message)
+        if not message.content and not attachments:
+            return
+        remember_dc_message(message)
+
+        ref = getattr(message, 'reference', None)
+        event = {
+            "route": route.name,
+            "text": message.content or "",
+            "attachments": attachments,
+            "username": message.author.display_name,
+            "dc_msg_id": message.id,
+            "reply_to_dc_id": getattr(ref, 'message_id', None) if ref else None,
+            "received": time.time(),
+        }
+        await self.dispatch(route, event)
+
+    async def on_raw_message_edit(self, payload):
+        data = payload.data
+        route = self.routes.for_dc(payload.channel_id)
+        # embed unfurls also arrive as edits but carry no content
+        if not route or "content" not in data:
             return
-        if message.channel.id != self.channel_id:
+        author = data.get("author") or {}
+        if self.is_echo(payload.channel_id, payload.message_id, author.get("id"), author.get("bot", False) or bool(data.get("webhook_id"))):
             return
-        if istg(message.content or ""):
+        if payload.cached_message:
+            username = payload.cached_message.author.display_name
+        else:
+            username = (data.get("member") or {}).get("nick") or author.get("global_name") or author.get("username")
+        event = {
+            "kind": "edit",
+            "route": route.name,
+            "text": data["content"],
+            "username": username,
+            "dc_msg_id": payload.message_id,
+            "edited_at": time.time(),
+        }
+        self.debouncer.schedule(("discord", route.name, payload.message_id), lambda: self.dispatch(route, event))
+
+    async def on_raw_message_delete(self, payload):
+        await self.deleted(payload.channel_id, [payload.message_id])
+
+    async def on_raw_bulk_message_delete(self, payload):
+        await self.deleted(payload.channel_id, payload.message_ids)
+
+    async def deleted(self, channel_id, message_ids):
+        route = self.routes.for_dc(channel_id)
+        if not route:
             return
+        for dc_msg_id in message_ids:
+            self.debouncer.cancel(("discord", route.name, dc_msg_id))
+            forget_dc_message(dc_msg_id)
+            await self.dispatch(route, {"kind": "delete", "route": route.name, "dc_msg_id": dc_msg_id, "deleted_at": time.time()})
+
+    async def dispatch(self, route, event):
+        if self.handoff:
+            await self.handoff("discord", route, event)
+            return
+        await self.handle_event(route, event)
+
+    async def handle_event(self, route, event):
+        kind = event.get("kind")
+        if kind == "edit":
+            await self.process_edit(route, event)
+        elif kind == "delete":
+            await self.process_delete(route, event)
+        else:
+            await self.process(route, event)
 
-        msg = ddformat(message.author.display_name, message.content or "")
+    async def process(self, route, event):
+        msg = ddformat(event["username"], event["text"])
 
         if not self.forward_to_telegram:
             return
 
         rly_tg_message_id = None
         reply_to_internal_id = None
-        reply_to_dc_id = None
-        ref = getattr(message, 'reference', None)
-        if ref and getattr(ref, 'message_id', None):
-            reply_to_dc_id = ref.message_id
-            rly_tg_message_id = self.map_dc_to_tg.get(ref.message_id)
+        reply_to_dc_id = event["reply_to_dc_id"]
+        if reply_to_dc_id:
             try:
-                m = await store_functions.find_by_dc_id(ref.message_id)
-                reply_to_internal_id = m["id"] if m else None
+                parent = await threads.resolve(dc_msg_id=reply_to_dc_id, route=route.name)
             except Exception:
-                reply_to_internal_id = None
+                parent = None
+            reply_to_internal_id = parent["id"] if parent else None
+            rly_tg_message_id = (parent or {}).get("tg_msg_id") or route.id_map.dc_to_tg.get(reply_to_dc_id)
 
-        dc_msg_id = message.id
-        await store_functions.add_message(
+        dc_msg_id = event["dc_msg_id"]
+        internal_id = await store_functions.add_message(
             source='discord',
-            text=message.content or "",
-            username=message.author.display_name,
+            text=event["text"],
+            username=event["username"],
             dc_msg_id=dc_msg_id,
             reply_to_dc_id=reply_to_dc_id,
             reply_to_tg_id=rly_tg_message_id,
             reply_to_id=reply_to_internal_id,
+            route=route.name,
+            attachments=storable(event["attachments"]),
+            deliver_to=["telegram"],
         )
-
-        tg_msg_id = await self.forward_to_telegram(msg, reply_to_telegram_message_id=rly_tg_message_id)
-        if tg_msg_id:
-            self.map_dc_to_tg[dc_msg_id] = tg_msg_id
-            self.map_tg_to_dc[tg_msg_id] = dc_msg_id
-            await store_functions.set_tg_id_for_dc(dc_msg_id, int(tg_msg_id))
+        threads.put({"id": internal_id, "route": route.name, "dc_msg_id": dc_msg_id, "reply_to_id": reply_to_internal_id})
+
+        async def on_sent(tg_msg_id):
+            observe_bridge("discord", "telegram", event.get("received"))
+            if tg_msg_id:
+                route.id_map.link(tg_msg_id, dc_msg_id)
+                threads.update(internal_id, tg_msg_id=tg_msg_id)
+                await self.outbox.sent(internal_id, "telegram", tg_msg_id)
+            if event["attachments"]:
+                # the send filled in destination refs
+                await store_functions.set_attachments(internal_id, storable(event["attachments"]))
+
+        if route.burst_window and not event["attachments"]:
+            await self.coalescer.add(route, event["username"], event["text"], rly_tg_message_id, on_sent, internal_id)
+            return
+        await self.coalescer.flush(route.name)
+        future = await self.forward_to_telegram(
+            route,
+            msg,
+            reply_to_telegram_message_id=rly_tg_message_id,
+            on_sent=on_sent,
+            attachments=event["attachments"],
+        )
+        self.outbox.track(internal_id, "telegram", future)
+
+    async def send_burst(self, route, message, reply_to, on_sent):
+        return await self.forward_to_telegram(route, message, reply_to_telegram_message_id=reply_to, on_sent=on_sent)
+
+    def track_burst(self, internal_id, future):
+        self.outbox.track(internal_id, "telegram", future)
+
+    async def process_edit(self, route, event):
+        dc_msg_id = event["dc_msg_id"]
+        await store_functions.record_edit(event["text"], dc_msg_id=dc_msg_id, route=route.name, edited_at=event["edited_at"])
+        tg_msg_id = await route.id_map.tg_for_dc(dc_msg_id)
+        if tg_msg_id and self.edit_on_telegram and not self.coalescer.is_merged(tg_msg_id):
+            await self.edit_on_telegram(route, tg_msg_id, ddformat(event["username"], event["text"]))
+
+    async def process_delete(self, route, event):
+        dc_msg_id = event["dc_msg_id"]
+        m = await store_functions.find_by_dc_id(dc_msg_id, route=route.name)
+        # only retract originals; deleting a bridged copy on Discord leaves the Telegram message alone
+        if not m or m.get("source") != "discord":
+            return
+        await store_functions.mark_deleted(dc_msg_id=dc_msg_id, route=route.name, deleted_at=event["deleted_at"])
+        tg_msg_id = m.get("tg_msg_id") or await route.id_map.tg_for_dc(dc_msg_id)
+        if tg_msg_id and self.delete_on_telegram and not self.coalescer.is_merged(tg_msg_id):
+            await self.delete_on_telegram(route, tg_msg_id)
 
     def create_client(self):
         self.client = discord.Client(intents=self.intents)
 
         self.client.event(self.on_ready)
         self.client.event(self.on_message)
+        self.client.event(self.on_raw_message_edit)
+        self.client.event(self.on_raw_message_delete)
+        self.client.event(self.on_raw_bulk_message_delete)
 
         return self.client
 
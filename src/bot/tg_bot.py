@@ -1,70 +1,248 @@
-from telegram.ext import Application, MessageHandler, filters
-from src.utils.bridge import isdd, tgformat
+import asyncio
+import time
+from telegram.ext import Application, BaseUpdateProcessor, MessageHandler, filters
+from src.utils.bridge import tgformat
+from src.core.coalesce import DISCORD_MESSAGE_LIMIT, Coalescer
+from src.core.debounce import Debouncer
+from src.core.echo import echoes
+from src.core.outbox import Outbox
+from src.core.threads import threads
+from src.utils.media import storable, tg_attachments
+from src.core.metrics import observe_bridge
 from src.database import store_functions
 
 
+MEDIA_FILTER = (
+    filters.PHOTO
+    | filters.Document.ALL
+    | filters.VIDEO
+    | filters.ANIMATION
+    | filters.AUDIO
+    | filters.VOICE
+    | filters.VIDEO_NOTE
+    | filters.Sticker.ALL
+)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates, ordering="chat"):
+        super().__init__(max_concurrent_updates)
+        self.ordering = ordering
+        self.locks = {}
+        self.waiting = {}
+        self.processed = 0
+
+    def ordering_key(self, update):
+        chat = update.effective_chat
+        if chat is None:
+            return None
+        message = update.effective_message
+        if self.ordering == "thread" and message is not None:
+            return chat.id, message.message_thread_id
+        return chat.id
+
+    async def process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.waiting[key] = self.waiting.get(key, 0) + 1
+        try:
+            # take the per-key lock before a concurrency slot so a busy chat can't starve the others
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self.processed += 1
+            self.waiting[key] -= 1
+            if not self.waiting[key]:
+                del self.waiting[key]
+                del self.locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "max_concurrent_updates": self.max_concurrent_updates,
+            "ordering": self.ordering,
+            "pending": sum(self.waiting.values()),
+            "busiest": max(self.waiting.values(), default=0),
+            "active_keys": len(self.waiting),
+            "processed": self.processed,
+        }
+
+
 class TelegramBot:
-    def __init__(self, chat_id, token):
-        self.chat_id = chat_id
+    def __init__(self, routes, token, edit_debounce=1.5, ignore_bots=False):
+        self.routes = routes
         self.token = token
+        self.ignore_bots = ignore_bots
         self.app = None
         self.forward_to_discord = None
-        self.map_tg_to_dc = {}
-        self.map_dc_to_tg = {}
+        self.edit_on_discord = None
+        self.handoff = None
+        self.debouncer = Debouncer(edit_debounce)
+        self.coalescer = Coalescer(tgformat, DISCORD_MESSAGE_LIMIT, self.send_burst, track=self.track_burst)
+        self.outbox = Outbox()
 
     def set_forward_callback(self, callback):
         self.forward_to_discord = callback
 
-    def set_message_maps(self, tg_to_dc, dc_to_tg):
-        self.map_tg_to_dc = tg_to_dc
-        self.map_dc_to_tg = dc_to_tg
+    def set_sync_callbacks(self, edit_callback):
+        self.edit_on_discord = edit_callback
+
+    def set_outbox(self, outbox):
+        self.outbox = outbox
+
+    def set_handoff(self, callback):
+        self.handoff = callback
+
+    def is_echo(self, message):
+        if echoes.seen("telegram", message.chat_id, message.message_id):
+            return True
+        # other bridges' bots, so chained bridges can't bounce a message back and forth
+        return self.ignore_bots and message.from_user is not None and message.from_user.is_bot
 
     async def handle_message(self, update, context):
-        if not update.message or not update.message.text or update.message.chat_id != self.chat_id:
+        if not update.message or self.is_echo(update.message):
+            return
+        text = update.message.text or update.message.caption or ""
+        attachments = tg_attachments(update.message)
+        if not text and not attachments:
             return
-        if isdd(update.message.text):
+        route = self.routes.for_tg(update.message.chat_id)
+        if not route:
             return
 
-        username = update.message.from_user.full_name
-        msg = tgformat(username, update.message.text)
+        reply = update.message.reply_to_message
+        event = {
+            "route": route.name,
+            "text": text,
+            "attachments": attachments,
+            "username": update.message.from_user.full_name,
+            "tg_msg_id": update.message.message_id,
+            "reply_to_tg_id": reply.message_id if reply else None,
+            "received": time.time(),
+        }
+        await self.dispatch(route, event)
+
+    async def handle_edit(self, update, context):
+        message = update.edited_message
+        if not message or self.is_echo(message):
+            return
+        route = self.routes.for_tg(message.chat_id)
+        if not route:
+            return
+        event = {
+            "kind": "edit",
+            "route": route.name,
+            "text": message.text or message.caption or "",
+            "username": message.from_user.full_name,
+            "tg_msg_id": message.message_id,
+            "edited_at": message.edit_date.timestamp() if message.edit_date else time.time(),
+        }
+        # users often fix a typo several times in a row; only the last version is bridged
+        self.debouncer.schedule(("telegram", route.name, message.message_id), lambda: self.dispatch(route, event))
+
+    async def dispatch(self, route, event):
+        if self.handoff:
+            await self.handoff("telegram", route, event)
+            return
+        await self.handle_event(route, event)
+
+    async def handle_event(self, route, event):
+        if event.get("kind") == "edit":
+            await self.process_edit(route, event)
+        else:
+            await self.process(route, event)
+
+    async def process(self, route, event):
+        username = event["username"]
+        msg = tgformat(username, event["text"])
 
         if not self.forward_to_discord:
             return
 
         reply_to_discord_message_id = None
         reply_to_internal_id = None
-        reply_to_tg_id = None
+        reply_to_tg_id = event["reply_to_tg_id"]
 
-        if update.message.reply_to_message:
-            replied_tg_id = update.message.reply_to_message.message_id
-            reply_to_tg_id = replied_tg_id
-            reply_to_discord_message_id = self.map_tg_to_dc.get(replied_tg_id)
+        if reply_to_tg_id:
             try:
-                m = await store_functions.find_by_tg_id(replied_tg_id)
-                reply_to_internal_id = m["id"] if m else None
+                parent = await threads.resolve(tg_msg_id=reply_to_tg_id, route=route.name)
             except Exception:
-                reply_to_internal_id = None
+                parent = None
+            reply_to_internal_id = parent["id"] if parent else None
+            # a copy sent moments ago is linked in the id map before its id reaches the store
+            reply_to_discord_message_id = (parent or {}).get("dc_msg_id") or route.id_map.tg_to_dc.get(reply_to_tg_id)
 
-        tg_msg_id = update.message.message_id
-        await store_functions.add_message(
+        tg_msg_id = event["tg_msg_id"]
+        internal_id = await store_functions.add_message(
             source='telegram',
-            text=update.message.text,
+            text=event["text"],
             username=username,
             tg_msg_id=tg_msg_id,
             reply_to_tg_id=reply_to_tg_id,
             reply_to_dc_id=reply_to_discord_message_id,
             reply_to_id=reply_to_internal_id,
+            route=route.name,
+            attachments=storable(event["attachments"]),
+            deliver_to=["discord"],
         )
+        threads.put({"id": internal_id, "route": route.name, "tg_msg_id": tg_msg_id, "reply_to_id": reply_to_internal_id})
+
+        async def on_sent(dc_msg_id):
+            observe_bridge("telegram", "discord", event.get("received"))
+            if dc_msg_id:
+                route.id_map.link(tg_msg_id, dc_msg_id)
+                threads.update(internal_id, dc_msg_id=dc_msg_id)
+                await self.outbox.sent(internal_id, "discord", dc_msg_id)
+            if event["attachments"]:
+                # the send filled in content hashes and destination refs
+                await store_functions.set_attachments(internal_id, storable(event["attachments"]))
+
+        if route.burst_window and not event["attachments"]:
+            await self.coalescer.add(route, username, event["text"], reply_to_discord_message_id, on_sent, internal_id)
+            return
+        # keep order: anything still buffered for this route goes out first
+        await self.coalescer.flush(route.name)
+        future = await self.forward_to_discord(
+            route,
+            msg,
+            reply_to_discord_message_id=reply_to_discord_message_id,
+            on_sent=on_sent,
+            attachments=event["attachments"],
+        )
+        self.outbox.track(internal_id, "discord", future)
+
+    async def send_burst(self, route, message, reply_to, on_sent):
+        return await self.forward_to_discord(route, message, reply_to_discord_message_id=reply_to, on_sent=on_sent)
+
+    def track_burst(self, internal_id, future):
+        self.outbox.track(internal_id, "discord", future)
 
-        dc_msg_id = await self.forward_to_discord(msg, reply_to_discord_message_id=reply_to_discord_message_id)
-        if dc_msg_id:
-            self.map_tg_to_dc[tg_msg_id] = dc_msg_id
-            self.map_dc_to_tg[dc_msg_id] = tg_msg_id
-            await store_functions.set_dc_id_for_tg(tg_msg_id, int(dc_msg_id))
+    async def process_edit(self, route, event):
+        tg_msg_id = event["tg_msg_id"]
+        await store_functions.record_edit(event["text"], tg_msg_id=tg_msg_id, route=route.name, edited_at=event["edited_at"])
+        dc_msg_id = await route.id_map.dc_for_tg(tg_msg_id)
+        # a merged burst can't take one line's edit without clobbering the others
+        if dc_msg_id and self.edit_on_discord and not self.coalescer.is_merged(dc_msg_id):
+            await self.edit_on_discord(route, dc_msg_id, tgformat(event["username"], event["text"]))
 
-    def create_application(self):
-        self.app = Application.builder().token(self.token).build()
+    def create_application(self, concurrency=1, ordering="chat"):
+        builder = Application.builder().token(self.token)
+        if concurrency > 1:
+            builder = builder.concurrent_updates(KeyedUpdateProcessor(concurrency, ordering))
+        self.app = builder.build()
+        self.app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, self.handle_edit))
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        self.app.add_handler(MessageHandler(MEDIA_FILTER, self.handle_message))
         return self.app
 
     def get_application(self):
@@ -6,6 +6,27 @@ except:
     pass
 
 
+def parse_routes(raw):
+    routes = []
+    for entry in raw.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        parts = entry.split(":")
+        if len(parts) not in (3, 4):
+            raise ValueError(f"Invalid route '{entry}', expected name:telegram_chat_id:discord_channel_id[:burst_window_ms]")
+        name, tg_chat, dc_channel = parts[:3]
+        route = {
+            "name": name.strip(),
+            "telegram_chat_id": int(tg_chat),
+            "discord_channel_id": int(dc_channel),
+        }
+        if len(parts) == 4:
+            route["burst_window_ms"] = int(parts[3])
+        routes.append(route)
+    return routes
+
+
 def load_config():
     tg_token = os.getenv("TELEGRAM_BOT_TOKEN", "")
     tg_chat = int(os.getenv("TELEGRAM_CHAT_ID", "0"))
@@ -15,19 +36,89 @@ def load_config():
     mongo_db = os.getenv("MONGO_DB", "")
     api_host = os.getenv("API_HOST", "localhost")
     api_port = int(os.getenv("API_PORT", "000"))
+    api_batch_max = int(os.getenv("API_BATCH_MAX", "100"))
+    fanout_timeout = float(os.getenv("FANOUT_TIMEOUT", "10"))
+    fanout_timeout_telegram = float(os.getenv("FANOUT_TIMEOUT_TELEGRAM", str(fanout_timeout)))
+    fanout_timeout_discord = float(os.getenv("FANOUT_TIMEOUT_DISCORD", str(fanout_timeout)))
+    id_map_size = int(os.getenv("ID_MAP_SIZE", "50000"))
+    id_map_ttl = int(os.getenv("ID_MAP_TTL", "604800"))
+    outbound_queue_size = int(os.getenv("OUTBOUND_QUEUE_SIZE", "1000"))
+    outbound_max_retries = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+    tg_global_rate = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+    tg_chat_rate = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+    dc_channel_rate = float(os.getenv("DISCORD_CHANNEL_RATE", "1"))
+    write_batch_size = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+    write_flush_interval = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.5"))
+    stream_buffer_size = int(os.getenv("STREAM_BUFFER_SIZE", "256"))
+    bridge_workers = int(os.getenv("BRIDGE_WORKERS", "0"))
+    tg_webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+    tg_webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+    tg_concurrency = int(os.getenv("TELEGRAM_CONCURRENCY", "1"))
+    tg_ordering = os.getenv("TELEGRAM_ORDERING", "chat")
+    media_discord_limit = int(os.getenv("MEDIA_DISCORD_LIMIT", str(10 * 1024 * 1024)))
+    media_telegram_limit = int(os.getenv("MEDIA_TELEGRAM_LIMIT", str(20 * 1024 * 1024)))
+    media_cache_size = int(os.getenv("MEDIA_CACHE_SIZE", "2000"))
+    edit_debounce = float(os.getenv("EDIT_DEBOUNCE", "1.5"))
+    burst_window_ms = int(os.getenv("BURST_WINDOW_MS", "0"))
+    echo_cache_size = int(os.getenv("ECHO_CACHE_SIZE", "10000"))
+    thread_cache_size = int(os.getenv("THREAD_CACHE_SIZE", "50000"))
+    thread_max_depth = int(os.getenv("THREAD_MAX_DEPTH", "50"))
+    ignore_bots = os.getenv("IGNORE_BOTS", "false").lower() in ("1", "true", "yes")
+    storage_backend = os.getenv("STORAGE_BACKEND", "mongo")
+    outbox_max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+    outbox_base_delay = float(os.getenv("OUTBOX_BASE_DELAY", "5"))
+    outbox_max_delay = float(os.getenv("OUTBOX_MAX_DELAY", "3600"))
+    outbox_grace = float(os.getenv("OUTBOX_GRACE", "120"))
+    outbox_interval = float(os.getenv("OUTBOX_INTERVAL", "10"))
+    outbox_batch = int(os.getenv("OUTBOX_BATCH", "100"))
+    retention_days = float(os.getenv("RETENTION_DAYS", "0"))
+    retention_mode = os.getenv("RETENTION_MODE", "ttl")
+    retention_interval = float(os.getenv("RETENTION_INTERVAL", "3600"))
+    archive_dir = os.getenv("ARCHIVE_DIR", "archive")
+    mongo_max_pool_size = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+    mongo_min_pool_size = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+    mongo_max_idle_ms = int(os.getenv("MONGO_MAX_IDLE_MS", "0"))
+    mongo_connect_timeout_ms = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "20000"))
+    mongo_server_selection_timeout_ms = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+    mongo_compressors = os.getenv("MONGO_COMPRESSORS", "")
+    mongo_write_w = os.getenv("MONGO_WRITE_W", "1")
+    mongo_write_journal = os.getenv("MONGO_WRITE_JOURNAL", "false").lower() in ("1", "true", "yes")
+    mongo_read_preference = os.getenv("MONGO_READ_PREFERENCE", "primary")
+    sqlite_path = os.getenv("SQLITE_PATH", "bindsync.db")
+
+    routes = parse_routes(os.getenv("BRIDGE_ROUTES", ""))
+    if not routes and tg_chat and dc_channel:
+        routes = [{"name": "default", "telegram_chat_id": tg_chat, "discord_channel_id": dc_channel}]
+    if routes:
+        tg_chat = routes[0]["telegram_chat_id"]
+        dc_channel = routes[0]["discord_channel_id"]
 
     missing = []
     if not tg_token:
         missing.append("TELEGRAM_TOKEN|TELEGRAM_BOT_TOKEN")
     if tg_chat == 0:
-        missing.append("TELEGRAM_CHAT_ID")
+        missing.append("TELEGRAM_CHAT_ID|BRIDGE_ROUTES")
     if not dc_token:
         missing.append("DISCORD_TOKEN|DISCORD_BOT_TOKEN")
     if dc_channel == 0:
-        missing.append("DISCORD_CHANNEL_ID")
-    if not mongo_uri:
+        missing.append("DISCORD_CHANNEL_ID|BRIDGE_ROUTES")
+    if tg_webhook_url and not tg_webhook_secret:
+        missing.append("TELEGRAM_WEBHOOK_SECRET")
+    if tg_ordering not in ("chat", "thread"):
+        raise ValueError("TELEGRAM_ORDERING must be 'chat' or 'thread'")
+    if storage_backend not in ("mongo", "sqlite", "memory"):
+        raise ValueError("STORAGE_BACKEND must be 'mongo', 'sqlite' or 'memory'")
+    if retention_mode not in ("ttl", "collection", "ndjson"):
+        raise ValueError("RETENTION_MODE must be 'ttl', 'collection' or 'ndjson'")
+    if retention_mode == "collection" and storage_backend != "mongo":
+        raise ValueError("RETENTION_MODE=collection needs STORAGE_BACKEND=mongo")
+    if storage_backend == "memory" and bridge_workers > 0:
+        raise ValueError("STORAGE_BACKEND=memory cannot be shared with BRIDGE_WORKERS")
+    if mongo_read_preference not in ("primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"):
+        raise ValueError("MONGO_READ_PREFERENCE must be a MongoDB read preference mode")
+    if storage_backend == "mongo" and not mongo_uri:
         missing.append("MONGO_URI")
-    if not mongo_db:
+    if storage_backend == "mongo" and not mongo_db:
         missing.append("MONGO_DB")
     if missing:
         raise ValueError("Missing environment variables: " + ", ".join(missing))
@@ -37,8 +128,56 @@ def load_config():
         "telegram_chat_id": tg_chat,
         "discord_token": dc_token,
         "discord_channel_id": dc_channel,
+        "routes": routes,
         "mongo_uri": mongo_uri,
         "mongo_db": mongo_db,
         "api_host": api_host,
         "api_port": api_port,
+        "api_batch_max": api_batch_max,
+        "fanout_timeouts": {"telegram": fanout_timeout_telegram, "discord": fanout_timeout_discord},
+        "id_map_size": id_map_size,
+        "id_map_ttl": id_map_ttl,
+        "outbound_queue_size": outbound_queue_size,
+        "outbound_max_retries": outbound_max_retries,
+        "telegram_global_rate": tg_global_rate,
+        "telegram_chat_rate": tg_chat_rate,
+        "discord_channel_rate": dc_channel_rate,
+        "write_batch_size": write_batch_size,
+        "write_flush_interval": write_flush_interval,
+        "stream_buffer_size": stream_buffer_size,
+        "bridge_workers": bridge_workers,
+        "telegram_webhook_url": tg_webhook_url,
+        "telegram_webhook_secret": tg_webhook_secret,
+        "telegram_concurrency": tg_concurrency,
+        "telegram_ordering": tg_ordering,
+        "media_discord_limit": media_discord_limit,
+        "media_telegram_limit": media_telegram_limit,
+        "media_cache_size": media_cache_size,
+        "edit_debounce": edit_debounce,
+        "burst_window_ms": burst_window_ms,
+        "echo_cache_size": echo_cache_size,
+        "thread_cache_size": thread_cache_size,
+        "thread_max_depth": thread_max_depth,
+        "ignore_bots": ignore_bots,
+        "storage_backend": storage_backend,
+        "outbox_max_attempts": outbox_max_attempts,
+        "outbox_base_delay": outbox_base_delay,
+        "outbox_max_delay": outbox_max_delay,
+        "outbox_grace": outbox_grace,
+        "outbox_interval": outbox_interval,
+        "outbox_batch": outbox_batch,
+        "retention_days": retention_days,
+        "retention_mode": retention_mode,
+        "retention_interval": retention_interval,
+        "archive_dir": archive_dir,
+        "mongo_max_pool_size": mongo_max_pool_size,
+        "mongo_min_pool_size": mongo_min_pool_size,
+        "mongo_max_idle_ms": mongo_max_idle_ms,
+        "mongo_connect_timeout_ms": mongo_connect_timeout_ms,
+        "mongo_server_selection_timeout_ms": mongo_server_selection_timeout_ms,
+        "mongo_compressors": mongo_compressors,
+        "mongo_write_w": int(mongo_write_w) if mongo_write_w.isdigit() else mongo_write_w,
+        "mongo_write_journal": mongo_write_journal,
+        "mongo_read_preference": mongo_read_preference,
+        "sqlite_path": sqlite_path,
     }
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from src.core import metrics
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+class Burst:
+    __slots__ = ("route", "author", "texts", "reply_to", "callbacks", "keys", "timer")
+
+    def __init__(self, route, author, reply_to):
+        self.route = route
+        self.author = author
+        self.texts = []
+        self.reply_to = reply_to
+        self.callbacks = []
+        self.keys = []
+        self.timer = None
+
+
+class Coalescer:
+    def __init__(self, fmt, limit, send, merged_size=5000, track=None):
+        self.fmt = fmt
+        self.limit = limit
+        self.send = send
+        # told about the send future once per message in the burst, so the outbox sees them all in flight
+        self.track = track
+        self.bursts = {}
+        self.merged_ids = OrderedDict()
+        self.merged_size = merged_size
+        self.counters = {"messages": 0, "sent": 0}
+
+    def fits(self, burst, text):
+        return len(self.fmt(burst.author, "\n".join(burst.texts + [text]))) <= self.limit
+
+    async def add(self, route, author, text, reply_to=None, on_sent=None, key=None):
+        self.counters["messages"] += 1
+        burst = self.bursts.get(route.name)
+        closed = None
+        # a reply has to sit on its own outbound message so the reference stays correct
+        if burst and (burst.author != author or reply_to or not self.fits(burst, text)):
+            closed = self._take(route.name)
+            burst = None
+        if burst is None:
+            burst = self.bursts[route.name] = Burst(route, author, reply_to)
+        else:
+            burst.timer.cancel()
+        burst.texts.append(text)
+        burst.callbacks.append(on_sent)
+        if key is not None:
+            burst.keys.append(key)
+        burst.timer = asyncio.create_task(self._expire(route.name, burst, route.burst_window))
+        if closed:
+            await self._send(closed)
+
+    async def _expire(self, name, burst, window):
+        await asyncio.sleep(window)
+        if self.bursts.get(name) is burst:
+            await self.flush(name)
+
+    def _take(self, name):
+        # detach synchronously so a concurrent add() never appends to a burst that is being sent
+        burst = self.bursts.pop(name, None)
+        if burst is not None and burst.timer is not None and burst.timer is not asyncio.current_task():
+            burst.timer.cancel()
+        return burst
+
+    async def flush(self, name):
+        burst = self._take(name)
+        if burst is not None:
+            await self._send(burst)
+
+    async def _send(self, burst):
+        name = burst.route.name
+        callbacks = [c for c in burst.callbacks if c]
+        merged = len(burst.texts) > 1
+
+        async def on_sent(dest_id):
+            # every original id maps onto the single merged destination message
+            if dest_id and merged:
+                self.merged_ids[int(dest_id)] = len(burst.texts)
+                while len(self.merged_ids) > self.merged_size:
+                    self.merged_ids.popitem(last=False)
+            for callback in callbacks:
+                try:
+                    await callback(dest_id)
+                except Exception:
+                    logger.exception(f"on_sent callback failed for burst on route {name}")
+
+        self.counters["sent"] += 1
+        if merged:
+            metrics.coalesced.labels(name).inc(len(burst.texts) - 1)
+        future = await self.send(burst.route, self.fmt(burst.author, "\n".join(burst.texts)), burst.reply_to, on_sent)
+        if self.track:
+            for key in burst.keys:
+                self.track(key, future)
+
+    def is_merged(self, dest_id):
+        return dest_id is not None and int(dest_id) in self.merged_ids
+
+    async def close(self):
+        for name in list(self.bursts):
+            await self.flush(name)
+
+    def stats(self):
+        return {**self.counters, "pending": len(self.bursts)}
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Debouncer:
+    def __init__(self, delay=1.5):
+        self.delay = delay
+        self.pending = {}
+        self.coalesced = 0
+
+    def schedule(self, key, action):
+        previous = self.pending.pop(key, None)
+        if previous is not None:
+            previous.cancel()
+            self.coalesced += 1
+        self.pending[key] = asyncio.create_task(self._run(key, action))
+
+    def cancel(self, key):
+        task = self.pending.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _run(self, key, action):
+        await asyncio.sleep(self.delay)
+        # past this point a newer schedule() must not cancel the running action
+        if self.pending.get(key) is asyncio.current_task():
+            del self.pending[key]
+        try:
+            await action()
+        except Exception:
+            logger.exception(f"Debounced action for {key} failed")
+
+    async def close(self):
+        tasks = list(self.pending.values())
+        self.pending.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
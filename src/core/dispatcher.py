@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from src.core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # push the bucket into debt so nothing leaves before retry_after has passed
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class OutboundJob:
+    __slots__ = ("send", "on_sent", "future", "enqueued")
+
+    def __init__(self, send, on_sent, future):
+        self.send = send
+        self.on_sent = on_sent
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+def retry_after_seconds(exc):
+    # telegram.error.RetryAfter and discord.RateLimited both carry retry_after
+    value = getattr(exc, "retry_after", None)
+    if value is None:
+        return None
+    if hasattr(value, "total_seconds"):
+        return value.total_seconds()
+    return float(value)
+
+
+class OutboundDispatcher:
+    def __init__(self, queue_size=1000, max_retries=3, tg_global_rate=30.0, tg_chat_rate=1.0, dc_channel_rate=1.0):
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.rates = {"telegram": (tg_chat_rate, 3), "discord": (dc_channel_rate, 5)}
+        self.global_limiters = {"telegram": RateLimiter(tg_global_rate, burst=tg_global_rate)}
+        self.queues = {}
+        self.limiters = {}
+        self.workers = {}
+        self.counters = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "backpressure": 0,
+        }
+        self.max_wait = 0.0
+
+    def _queue(self, platform, dest):
+        key = (platform, dest)
+        q = self.queues.get(key)
+        if q is None:
+            q = asyncio.Queue(maxsize=self.queue_size)
+            rate, burst = self.rates.get(platform, (0, 1))
+            self.queues[key] = q
+            self.limiters[key] = RateLimiter(rate, burst)
+            self.workers[key] = asyncio.create_task(self._worker(key, q))
+        return q
+
+    async def submit(self, platform, dest, send, on_sent=None):
+        q = self._queue(platform, dest)
+        job = OutboundJob(send, on_sent, asyncio.get_running_loop().create_future())
+        if q.full():
+            self.counters["backpressure"] += 1
+        await q.put(job)
+        self.counters["enqueued"] += 1
+        metrics.queue_depth.labels(platform, str(dest)).set(q.qsize())
+        return job.future
+
+    async def _worker(self, key, q):
+        while True:
+            job = await q.get()
+            metrics.queue_depth.labels(key[0], str(key[1])).set(q.qsize())
+            try:
+                await self._deliver(key, job)
+            except Exception:
+                logger.exception(f"Outbound worker error for {key}")
+                if not job.future.done():
+                    job.future.set_result(None)
+            finally:
+                q.task_done()
+
+    async def _deliver(self, key, job):
+        platform, _ = key
+        limiter = self.limiters[key]
+        global_limiter = self.global_limiters.get(platform)
+        self.max_wait = max(self.max_wait, time.monotonic() - job.enqueued)
+
+        result = None
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire()
+            if global_limiter:
+                await global_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                result = await job.send()
+                metrics.send_latency.labels(platform).observe(time.perf_counter() - start)
+                break
+            except Exception as e:
+                delay = retry_after_seconds(e)
+                if delay is None or attempt == self.max_retries:
+                    self.counters["failed"] += 1
+                    metrics.sends.labels(platform, "failed").inc()
+                    metrics.drops.labels("send_failed").inc()
+                    logger.error(f"Failed to send to {platform} {key[1]}: {e}")
+                    job.future.set_result(None)
+                    return
+                self.counters["retried"] += 1
+                metrics.retries.labels(platform).inc()
+                logger.warning(f"Rate limited by {platform}, retrying in {delay}s")
+                limiter.pause(delay)
+                if global_limiter:
+                    global_limiter.pause(delay)
+
+        self.counters["sent"] += 1
+        metrics.sends.labels(platform, "sent").inc()
+        if job.on_sent:
+            try:
+                await job.on_sent(result)
+            except Exception:
+                logger.exception(f"on_sent callback failed for {key}")
+        job.future.set_result(result)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "max_wait_seconds": round(self.max_wait, 3),
+            "queues": {
+                f"{platform}:{dest}": q.qsize() for (platform, dest), q in self.queues.items()
+            },
+        }
+
+    async def close(self, timeout=10):
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self.queues.values())),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Outbound queues not drained before shutdown")
+        for task in self.workers.values():
+            task.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
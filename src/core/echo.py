@@ -0,0 +1,30 @@
+from collections import OrderedDict
+
+
+class EchoFilter:
+    def __init__(self, size=10000):
+        self.size = size
+        # (platform, chat/channel id, message id) of everything this process posted
+        self.sent = OrderedDict()
+        self.dropped = 0
+
+    def add(self, platform, chat_id, message_id):
+        if not message_id:
+            return
+        key = (platform, int(chat_id), int(message_id))
+        self.sent[key] = None
+        self.sent.move_to_end(key)
+        while len(self.sent) > self.size:
+            self.sent.popitem(last=False)
+
+    def seen(self, platform, chat_id, message_id):
+        if (platform, int(chat_id), int(message_id)) in self.sent:
+            self.dropped += 1
+            return True
+        return False
+
+    def stats(self):
+        return {"size": self.size, "tracked": len(self.sent), "dropped": self.dropped}
+
+
+echoes = EchoFilter()
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def _one(platform, future, timeout):
+    try:
+        # shielded: a timeout stops the wait, not the send
+        dest_msg_id = await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Delivery to {platform} still pending after {timeout}s")
+        return {"status": "timeout", "id": None}
+    except Exception as e:
+        logger.exception(f"Delivery to {platform} failed")
+        return {"status": "failed", "id": None, "error": str(e)}
+    if not dest_msg_id:
+        return {"status": "failed", "id": None}
+    return {"status": "sent", "id": dest_msg_id}
+
+
+async def fan_out(futures, timeouts=None):
+    # latency is the slowest destination, not the sum; one result per destination and never raises
+    futures = {p: asyncio.ensure_future(f) for p, f in futures.items() if f is not None}
+    results = await asyncio.gather(*(
+        _one(p, f, timeouts.get(p) if isinstance(timeouts, dict) else timeouts)
+        for p, f in futures.items()
+    ))
+    return dict(zip(futures, results))
+
+
+def sent_ids(results):
+    return {p: r["id"] for p, r in results.items() if r["id"]}
+
+
+class Backfill:
+    # ids that land within the fan-out go to the store in one update; a destination that
+    # outlives its timeout writes its own as soon as it lands
+    def __init__(self, write):
+        self.write = write
+        self.ids = {}
+        self.merging = True
+
+    async def sent(self, platform, dest_msg_id):
+        if self.merging:
+            self.ids[platform] = dest_msg_id
+        else:
+            await self.write({platform: dest_msg_id})
+
+    async def flush(self):
+        self.merging = False
+        ids, self.ids = self.ids, {}
+        if ids:
+            await self.write(ids)
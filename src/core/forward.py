@@ -4,11 +4,25 @@ import uvicorn
 from src.bot.tg_bot import TelegramBot
 from src.bot.dc_bot import DiscordBot
 from src.config import load_config
-from src.database import database, store_functions
+from src.database import database, retention, store_functions
 from src.api.server import app, set_runtime
+from src.core.routes import RouteTable
+from src.core.dispatcher import OutboundDispatcher
+from src.core.echo import echoes
+from src.core.hub import hub
+from src.core.outbox import Outbox
+from src.core.supervisor import Supervisor
+from src.core.threads import threads
+from src.utils import media
 from src.utils.bridge import (
+    apiformat,
+    ddformat,
+    delete_tg,
+    edit_dd,
+    edit_tg,
     fwd_dd_with_reply as util_forward_dc_reply,
     fwd_to_tg_rply as util_forward_tg_reply,
+    tgformat,
 )
 
 logging.basicConfig(
@@ -21,56 +35,249 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def main():
-    cfg = load_config()
+async def warm_media(cfg):
+    # oldest first, so the newest refs end up most recently used
+    docs = await store_functions.list_messages(limit=cfg["media_cache_size"], fields=["attachments"])
+    media.warm(reversed(docs))
 
-    await database.init_db(cfg["mongo_uri"], cfg["mongo_db"])
-    await store_functions.configure()
-    logger.info("Connected to MongoDB")
 
-    map_tg_to_dc = {}
-    map_dc_to_tg = {}
+def make_dispatcher(cfg):
+    media.configure(cfg.get("media_discord_limit"), cfg.get("media_telegram_limit"), cfg.get("media_cache_size"))
+    # the supervisor sends too (API messages, outbox replays), so the bot-wide budget splits workers + 1 ways;
+    # per-chat limits stay per process, so a route's API and bot traffic are paced and ordered separately
+    processes = cfg["bridge_workers"] + 1 if cfg.get("bridge_workers") else 1
+    return OutboundDispatcher(
+        queue_size=cfg["outbound_queue_size"],
+        max_retries=cfg["outbound_max_retries"],
+        tg_global_rate=cfg["telegram_global_rate"] / processes,
+        tg_chat_rate=cfg["telegram_chat_rate"],
+        dc_channel_rate=cfg["discord_channel_rate"],
+    )
 
-    tg_bot_instance = TelegramBot(chat_id=cfg["telegram_chat_id"], token=cfg["telegram_token"])
-    dc_bot_instance = DiscordBot(channel_id=cfg["discord_channel_id"])
 
-    tbot = tg_bot_instance.create_application()
-    dbot = dc_bot_instance.create_client()
+def make_forwarders(tbot, dbot, dispatcher):
+    async def fwd_to_dd(route, message, reply_to_discord_message_id=None, on_sent=None, attachments=None):
+        async def send():
+            if attachments:
+                return await media.send_media_to_discord(
+                    tbot,
+                    dbot,
+                    route.discord_channel_id,
+                    message,
+                    attachments,
+                    reply_to=reply_to_discord_message_id,
+                )
+            return await util_forward_dc_reply(
+                dbot,
+                route.discord_channel_id,
+                message,
+                message_id=reply_to_discord_message_id,
+            )
+
+        return await dispatcher.submit("discord", route.discord_channel_id, send, on_sent)
+
+    async def forward_to_telegram(route, message, reply_to_telegram_message_id=None, on_sent=None, attachments=None):
+        async def send():
+            if attachments:
+                return await media.send_media_to_telegram(
+                    tbot,
+                    route.telegram_chat_id,
+                    message,
+                    attachments,
+                    reply_to=reply_to_telegram_message_id,
+                )
+            return await util_forward_tg_reply(
+                tbot,
+                route.telegram_chat_id,
+                message,
+                msg_id=reply_to_telegram_message_id,
+            )
 
-    async def fwd_to_dd(message, reply_to_discord_message_id=None):
-        return await util_forward_dc_reply(
-            dbot,
-            cfg["discord_channel_id"],
-            message,
-            message_id=reply_to_discord_message_id,
+        return await dispatcher.submit("telegram", route.telegram_chat_id, send, on_sent)
+
+    return fwd_to_dd, forward_to_telegram
+
+
+def make_sync(tbot, dbot, dispatcher):
+    async def edit_on_discord(route, dc_msg_id, message):
+        return await dispatcher.submit(
+            "discord",
+            route.discord_channel_id,
+            lambda: edit_dd(dbot, route.discord_channel_id, dc_msg_id, message),
         )
 
-    async def forward_to_telegram(message, reply_to_telegram_message_id=None):
-        return await util_forward_tg_reply(
-            tbot,
-            cfg["telegram_chat_id"],
-            message,
-            msg_id=reply_to_telegram_message_id,
+    async def edit_on_telegram(route, tg_msg_id, message):
+        return await dispatcher.submit(
+            "telegram",
+            route.telegram_chat_id,
+            lambda: edit_tg(tbot, route.telegram_chat_id, tg_msg_id, message),
         )
 
+    async def delete_on_telegram(route, tg_msg_id):
+        return await dispatcher.submit(
+            "telegram",
+            route.telegram_chat_id,
+            lambda: delete_tg(tbot, route.telegram_chat_id, tg_msg_id),
+        )
+
+    # Telegram sends no deletion events, so deletes only ever go Discord -> Telegram
+    return edit_on_discord, edit_on_telegram, delete_on_telegram
+
+
+def configure_threads(cfg):
+    threads.max_size = cfg["thread_cache_size"]
+    threads.ttl = cfg["id_map_ttl"]
+    threads.max_depth = cfg["thread_max_depth"]
+
+
+def make_outbox(cfg):
+    return Outbox(
+        max_attempts=cfg["outbox_max_attempts"],
+        base_delay=cfg["outbox_base_delay"],
+        max_delay=cfg["outbox_max_delay"],
+        timeouts=cfg["fanout_timeouts"],
+        lease=cfg["outbox_grace"],
+    )
+
+
+def make_replay(routes, fwd_to_dd, forward_to_telegram, outbox):
+    reply_fields = {"telegram": ("reply_to_tg_id", "tg_msg_id"), "discord": ("reply_to_dc_id", "dc_msg_id")}
+    formats = {"telegram": tgformat, "discord": ddformat}
+
+    async def replay(doc, platform):
+        route = routes.get(doc.get("route"))
+        if not route:
+            return None
+        reply_field, id_field = reply_fields[platform]
+        reply_to = doc.get(reply_field)
+        if not reply_to and doc.get("reply_to_id"):
+            original = await store_functions.get_message(doc["reply_to_id"])
+            reply_to = original.get(id_field) if original else None
+        message = formats.get(doc.get("source"), apiformat)(doc.get("username"), doc.get("text"))
+
+        async def on_sent(dest_msg_id):
+            if not dest_msg_id:
+                return
+            await outbox.sent(doc["id"], platform, dest_msg_id)
+            if doc.get("attachments"):
+                await store_functions.set_attachments(doc["id"], media.storable(doc["attachments"]))
+            threads.update(doc["id"], **{store_functions.PLATFORM_ID_FIELDS[platform]: dest_msg_id})
+            if platform == "discord" and doc.get("tg_msg_id"):
+                route.id_map.link(doc["tg_msg_id"], dest_msg_id)
+            elif platform == "telegram" and doc.get("dc_msg_id"):
+                route.id_map.link(dest_msg_id, doc["dc_msg_id"])
+
+        if platform == "discord":
+            return await fwd_to_dd(route, message, reply_to_discord_message_id=reply_to, on_sent=on_sent, attachments=doc.get("attachments"))
+        return await forward_to_telegram(route, message, reply_to_telegram_message_id=reply_to, on_sent=on_sent, attachments=doc.get("attachments"))
+
+    return replay
+
+
+async def main():
+    cfg = load_config()
+
+    store = await database.init_store(cfg)
+    routes = RouteTable.from_config(cfg)
+    max_age = int(cfg["retention_days"] * 86400)
+    ttl = retention.native_ttl(cfg)
+    await store_functions.configure(
+        default_route=routes.default.name,
+        ttl=ttl,
+        delivery_grace=cfg["outbox_grace"],
+    )
+    logger.info(f"Connected to {store.name} storage")
+    retention_task = None
+    if max_age and not ttl:
+        retention_task = asyncio.create_task(
+            retention.run(cfg["retention_mode"], max_age, cfg["archive_dir"], cfg["retention_interval"])
+        )
+    store_functions.start_writer(cfg["write_batch_size"], cfg["write_flush_interval"])
+    hub.buffer_size = cfg["stream_buffer_size"]
+    echoes.size = cfg["echo_cache_size"]
+    configure_threads(cfg)
+    store_functions.add_listener(hub.publish)
+
+    supervisor = None
+    if cfg["bridge_workers"] > 0:
+        supervisor = Supervisor(cfg, routes)
+        supervisor.start()
+        logger.info(f"Started {cfg['bridge_workers']} bridge workers")
+    else:
+        for route in routes:
+            warmed = await route.id_map.warm()
+            logger.info(f"Route {route.name}: loaded {warmed} message id pairs")
+
+    tg_bot_instance = TelegramBot(
+        routes=routes,
+        token=cfg["telegram_token"],
+        edit_debounce=cfg["edit_debounce"],
+        ignore_bots=cfg["ignore_bots"],
+    )
+    dc_bot_instance = DiscordBot(routes=routes, edit_debounce=cfg["edit_debounce"], ignore_bots=cfg["ignore_bots"])
+
+    tbot = tg_bot_instance.create_application(
+        concurrency=cfg["telegram_concurrency"],
+        ordering=cfg["telegram_ordering"],
+    )
+    dbot = dc_bot_instance.create_client()
+
+    dispatcher = make_dispatcher(cfg)
+    await warm_media(cfg)
+    fwd_to_dd, forward_to_telegram = make_forwarders(tbot, dbot, dispatcher)
+    edit_on_discord, edit_on_telegram, delete_on_telegram = make_sync(tbot, dbot, dispatcher)
+
     # Set up forward callbacks properly
     tg_bot_instance.set_forward_callback(fwd_to_dd)
-    tg_bot_instance.set_message_maps(map_tg_to_dc, map_dc_to_tg)
-
+    tg_bot_instance.set_sync_callbacks(edit_on_discord)
     dc_bot_instance.set_forward_callback(forward_to_telegram)
-    dc_bot_instance.set_message_maps(map_tg_to_dc, map_dc_to_tg)
+    dc_bot_instance.set_sync_callbacks(edit_on_telegram, delete_on_telegram)
+    outbox = make_outbox(cfg)
+    outbox.set_replay(make_replay(routes, fwd_to_dd, forward_to_telegram, outbox))
+    tg_bot_instance.set_outbox(outbox)
+    dc_bot_instance.set_outbox(outbox)
+    if supervisor:
+        tg_bot_instance.set_handoff(supervisor.handoff)
+        dc_bot_instance.set_handoff(supervisor.handoff)
 
-    set_runtime(tbot, dbot, cfg, map_tg_to_dc, map_dc_to_tg)
+    set_runtime(tbot, dbot, cfg, routes, dispatcher, supervisor, outbox)
 
     config = uvicorn.Config(app, host=cfg["api_host"], port=cfg["api_port"], log_level="info")
     server = uvicorn.Server(config)
     api_task = asyncio.create_task(server.serve())
 
     async with tbot, dbot:
-        logger.info("Starting Telegram bot polling...")
         await tbot.initialize()
         await tbot.start()
+        if cfg["telegram_webhook_url"]:
+            logger.info("Registering Telegram webhook...")
+            await tbot.bot.set_webhook(
+                url=cfg["telegram_webhook_url"],
+                secret_token=cfg["telegram_webhook_secret"],
+                max_connections=max(1, cfg["telegram_concurrency"]),
+            )
+            tasks = [api_task]
+        else:
+            logger.info("Starting Telegram bot polling...")
+            tasks = [api_task, asyncio.create_task(tbot.updater.start_polling())]
         logger.info("Starting Discord bot...")
-        discord_task = asyncio.create_task(dbot.start(cfg["discord_token"]))
-        polling_task = asyncio.create_task(tbot.updater.start_polling())
-        await asyncio.gather(api_task, discord_task, polling_task)
+        tasks.append(asyncio.create_task(dbot.start(cfg["discord_token"])))
+        # replays whatever a previous run stored but never delivered
+        outbox_task = asyncio.create_task(outbox.run(cfg["outbox_interval"], cfg["outbox_batch"]))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            outbox_task.cancel()
+            if retention_task:
+                retention_task.cancel()
+            await tg_bot_instance.debouncer.close()
+            await dc_bot_instance.debouncer.close()
+            await tg_bot_instance.coalescer.close()
+            await dc_bot_instance.coalescer.close()
+            if supervisor:
+                await supervisor.stop()
+            await dispatcher.close()
+            await outbox.close()
+            await media.close()
+            await store_functions.stop_writer()
+            await database.close_store()
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from src.core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, hub, buffer_size):
+        self.hub = hub
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = False
+
+    def offer(self, message):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # slow consumer: cut it loose instead of buffering without bound
+            self.dropped = True
+            self.hub.unsubscribe(self)
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class MessageHub:
+    def __init__(self, buffer_size=256):
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        sub = Subscription(self, self.buffer_size)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub in self.subscribers:
+            self.subscribers.discard(sub)
+            if sub.dropped:
+                self.dropped += 1
+                metrics.drops.labels("slow_subscriber").inc()
+                logger.warning("Dropped slow message stream subscriber")
+
+    def publish(self, message):
+        self.published += 1
+        for sub in list(self.subscribers):
+            sub.offer(message)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+hub = MessageHub()
@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+from src.core import metrics
+from src.database import store_functions
+
+
+class BoundedIdMap:
+    def __init__(self, max_size=50000, ttl=604800):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def _prune(self, now):
+        while self._data:
+            key, (_, expires) = next(iter(self._data.items()))
+            if expires > now:
+                break
+            del self._data[key]
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        key = int(key)
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        key = int(key)
+        now = time.monotonic()
+        self._data[key] = (int(value), now + self.ttl)
+        self._data.move_to_end(key)
+        self._prune(now)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(int(key), None)
+        return entry[0] if entry else default
+
+    def clear(self):
+        self._data.clear()
+
+
+class MessageIdMap:
+    def __init__(self, max_size=50000, ttl=604800, route=None):
+        self.route = route
+        self.tg_to_dc = BoundedIdMap(max_size, ttl)
+        self.dc_to_tg = BoundedIdMap(max_size, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def link(self, tg_msg_id, dc_msg_id):
+        if tg_msg_id is None or dc_msg_id is None:
+            return
+        self.tg_to_dc[tg_msg_id] = dc_msg_id
+        self.dc_to_tg[dc_msg_id] = tg_msg_id
+
+    async def dc_for_tg(self, tg_msg_id):
+        if tg_msg_id is None:
+            return None
+        dc_msg_id = self.tg_to_dc.get(tg_msg_id)
+        if dc_msg_id is not None:
+            self.hits += 1
+            metrics.id_map_lookups.labels("hit").inc()
+            return dc_msg_id
+        self.misses += 1
+        metrics.id_map_lookups.labels("miss").inc()
+        m = await store_functions.find_by_tg_id(tg_msg_id, route=self.route)
+        if m and m.get("dc_msg_id"):
+            dc_msg_id = int(m["dc_msg_id"])
+            self.link(tg_msg_id, dc_msg_id)
+        return dc_msg_id
+
+    async def tg_for_dc(self, dc_msg_id):
+        if dc_msg_id is None:
+            return None
+        tg_msg_id = self.dc_to_tg.get(dc_msg_id)
+        if tg_msg_id is not None:
+            self.hits += 1
+            metrics.id_map_lookups.labels("hit").inc()
+            return tg_msg_id
+        self.misses += 1
+        metrics.id_map_lookups.labels("miss").inc()
+        m = await store_functions.find_by_dc_id(dc_msg_id, route=self.route)
+        if m and m.get("tg_msg_id"):
+            tg_msg_id = int(m["tg_msg_id"])
+            self.link(tg_msg_id, dc_msg_id)
+        return tg_msg_id
+
+    async def warm(self, limit=None):
+        limit = limit or self.tg_to_dc.max_size
+        pairs = await store_functions.recent_id_pairs(limit, route=self.route)
+        # oldest first so the most recent pairs end up at the LRU tail
+        for tg_msg_id, dc_msg_id in reversed(pairs):
+            self.link(tg_msg_id, dc_msg_id)
+        return len(pairs)
+
+    def stats(self):
+        return {
+            "size": len(self.tg_to_dc),
+            "max_size": self.tg_to_dc.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,56 @@
+import functools
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+bridge_latency = Histogram(
+    "bindsync_bridge_latency_seconds",
+    "Time from receiving a message to the destination platform acknowledging the copy",
+    ["source", "destination"],
+    buckets=LATENCY_BUCKETS,
+)
+store_latency = Histogram(
+    "bindsync_store_op_seconds",
+    "Latency of store_functions calls",
+    ["op"],
+    buckets=LATENCY_BUCKETS,
+)
+send_latency = Histogram(
+    "bindsync_send_seconds",
+    "Latency of Telegram/Discord send calls",
+    ["platform"],
+    buckets=LATENCY_BUCKETS,
+)
+sends = Counter("bindsync_sends_total", "Outbound sends by result", ["platform", "result"])
+retries = Counter("bindsync_send_retries_total", "Outbound sends retried after a rate limit", ["platform"])
+drops = Counter("bindsync_dropped_total", "Messages or subscribers dropped", ["reason"])
+id_map_lookups = Counter("bindsync_id_map_lookups_total", "Message id map lookups", ["result"])
+thread_lookups = Counter("bindsync_thread_lookups_total", "Reply thread cache lookups", ["result"])
+coalesced = Counter("bindsync_coalesced_messages_total", "Inbound messages merged into an earlier outbound message", ["route"])
+mongo_pool_open = Gauge("bindsync_mongo_pool_connections", "Open MongoDB pool connections", ["address"])
+mongo_pool_checked_out = Gauge("bindsync_mongo_pool_checked_out", "MongoDB connections currently checked out", ["address"])
+mongo_pool_checkout_failures = Counter("bindsync_mongo_pool_checkout_failures_total", "MongoDB connection checkouts that failed", ["reason"])
+queue_depth = Gauge("bindsync_outbound_queue_depth", "Outbound queue depth", ["platform", "destination"])
+
+
+def observe_bridge(source, destination, received):
+    if received:
+        bridge_latency.labels(source, destination).observe(max(0.0, time.time() - received))
+
+
+def timed(op):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                store_latency.labels(op).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
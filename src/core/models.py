@@ -1,3 +1,4 @@
+from typing import List
 from pydantic import BaseModel
 
 
@@ -5,9 +6,14 @@ class MessageCreate(BaseModel):
     text: str
     username: str = "API"
     reply_to_id: str = None
+    route: str = None
 
 
 class MessageReply(BaseModel):
     text: str
     username: str = "API"
 
+
+
+class MessageBatch(BaseModel):
+    messages: List[MessageCreate]
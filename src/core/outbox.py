@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from src.database import store_functions
+
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    def __init__(self, max_attempts=8, base_delay=5.0, max_delay=3600.0, remembered=10000, timeouts=None, lease=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.remembered = remembered
+        self.timeouts = timeouts
+        # seconds a send keeps its entry out of every process's recovery; renewed while it is still going
+        self.lease = lease
+        # idempotency keys ("<internal id>:<platform>") sent or being sent by this process
+        self.inflight = set()
+        self.delivered = OrderedDict()
+        self.tasks = set()
+        self.replay = None
+        self.counters = {"sent": 0, "retried": 0, "failed": 0, "replayed": 0, "timeouts": 0}
+
+    def set_replay(self, callback):
+        self.replay = callback
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def busy(self, key):
+        return key in self.inflight or key in self.delivered
+
+    def remember(self, key, dest_msg_id):
+        self.delivered[key] = dest_msg_id
+        while len(self.delivered) > self.remembered:
+            self.delivered.popitem(last=False)
+
+    async def sent(self, internal_id, platform, dest_msg_id):
+        await self.sent_all(internal_id, {platform: dest_msg_id})
+
+    async def sent_all(self, internal_id, sent):
+        sent = {platform: int(dest_msg_id) for platform, dest_msg_id in sent.items()}
+        for platform, dest_msg_id in sent.items():
+            self.remember(f"{internal_id}:{platform}", dest_msg_id)
+        self.counters["sent"] += len(sent)
+        await store_functions.mark_sent_all(internal_id, sent)
+
+    def track(self, internal_id, platform, future, attempts=0):
+        if future is None:
+            return
+        key = f"{internal_id}:{platform}"
+        self.inflight.add(key)
+        task = asyncio.ensure_future(self._settle(key, internal_id, platform, future, attempts))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _settle(self, key, internal_id, platform, future, attempts):
+        future = asyncio.ensure_future(future)
+        timeout = self.timeouts.get(platform) if isinstance(self.timeouts, dict) else self.timeouts
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            waits = [self.lease / 2] if self.lease else []
+            if deadline:
+                waits.append(max(0.0, deadline - time.monotonic()))
+            done, _ = await asyncio.wait({future}, timeout=min(waits) if waits else None)
+            if done:
+                break
+            if deadline and time.monotonic() >= deadline:
+                # still queued or sending: the key stays in flight until the send settles
+                logger.warning(f"Delivery of {key} still pending after {timeout}s")
+                self.counters["timeouts"] += 1
+                deadline = None
+            if self.lease:
+                await store_functions.extend_lease(internal_id, platform, time.time() + self.lease)
+        failed = future.cancelled() or future.exception() is not None
+        await self._finish(key, internal_id, platform, None if failed else future.result(), attempts)
+
+    async def _finish(self, key, internal_id, platform, dest_msg_id, attempts):
+        self.inflight.discard(key)
+        if dest_msg_id:
+            # the back-fill may still be waiting on a merged update; recovery must not resend meanwhile
+            self.remember(key, dest_msg_id)
+        elif key not in self.delivered:
+            await self.retry_later(internal_id, platform, attempts + 1)
+
+    async def retry_later(self, internal_id, platform, attempts):
+        failed = attempts >= self.max_attempts
+        self.counters["failed" if failed else "retried"] += 1
+        if failed:
+            logger.error(f"Giving up on delivering {internal_id}:{platform} after {attempts} attempts")
+        await store_functions.mark_attempt(internal_id, platform, attempts, time.time() + self.backoff(attempts), failed)
+
+    async def recover(self, batch_size=100):
+        replayed = 0
+        now = time.time()
+        for doc in await store_functions.due_deliveries(now, limit=batch_size):
+            for platform, entry in (doc.get("delivery") or {}).items():
+                key = entry.get("key") or f"{doc['id']}:{platform}"
+                if entry.get("state") != "pending" or entry.get("next_at", 0) > now or self.busy(key):
+                    continue
+                attempts = entry.get("attempts", 0)
+                # a back-filled destination id means the send landed but the state change was lost
+                dest_msg_id = doc.get(store_functions.PLATFORM_ID_FIELDS[platform])
+                if dest_msg_id:
+                    await store_functions.mark_sent(doc["id"], platform, dest_msg_id)
+                    continue
+                if self.lease:
+                    # claimed before the send starts, so the next pass does not pick it up again
+                    await store_functions.extend_lease(doc["id"], platform, now + self.lease)
+                try:
+                    future = await self.replay(doc, platform)
+                except Exception:
+                    logger.exception(f"Replay of {key} failed")
+                    future = None
+                if future is None:
+                    await self.retry_later(doc["id"], platform, attempts + 1)
+                    continue
+                self.track(doc["id"], platform, future, attempts)
+                replayed += 1
+        self.counters["replayed"] += replayed
+        return replayed
+
+    async def run(self, interval=10.0, batch_size=100):
+        while True:
+            try:
+                replayed = await self.recover(batch_size)
+                if replayed:
+                    logger.info(f"Outbox replayed {replayed} pending deliveries")
+            except Exception:
+                logger.exception("Outbox recovery failed")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {**self.counters, "inflight": len(self.inflight)}
+
+    async def close(self):
+        await asyncio.gather(*self.tasks, return_exceptions=True)
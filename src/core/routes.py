@@ -0,0 +1,74 @@
+from src.core.idmap import MessageIdMap
+
+
+class Route:
+    __slots__ = ("name", "telegram_chat_id", "discord_channel_id", "id_map", "burst_window")
+
+    def __init__(self, name, telegram_chat_id, discord_channel_id, id_map=None, burst_window=0):
+        self.name = name
+        self.telegram_chat_id = int(telegram_chat_id)
+        self.discord_channel_id = int(discord_channel_id)
+        self.id_map = id_map
+        self.burst_window = burst_window
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "telegram_chat_id": self.telegram_chat_id,
+            "discord_channel_id": self.discord_channel_id,
+            "burst_window_ms": int(self.burst_window * 1000),
+        }
+
+
+class RouteTable:
+    def __init__(self, routes=()):
+        self.routes = {}
+        self.by_tg = {}
+        self.by_dc = {}
+        for route in routes:
+            self.add(route)
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            Route(
+                r["name"],
+                r["telegram_chat_id"],
+                r["discord_channel_id"],
+                MessageIdMap(max_size=cfg["id_map_size"], ttl=cfg["id_map_ttl"], route=r["name"]),
+                burst_window=r.get("burst_window_ms", cfg.get("burst_window_ms", 0)) / 1000,
+            )
+            for r in cfg["routes"]
+        )
+
+    def add(self, route):
+        if route.name in self.routes:
+            raise ValueError(f"Duplicate route name: {route.name}")
+        if route.telegram_chat_id in self.by_tg:
+            raise ValueError(f"Telegram chat {route.telegram_chat_id} is bridged twice")
+        if route.discord_channel_id in self.by_dc:
+            raise ValueError(f"Discord channel {route.discord_channel_id} is bridged twice")
+        self.routes[route.name] = route
+        self.by_tg[route.telegram_chat_id] = route
+        self.by_dc[route.discord_channel_id] = route
+
+    def for_tg(self, chat_id):
+        return self.by_tg.get(chat_id)
+
+    def for_dc(self, channel_id):
+        return self.by_dc.get(channel_id)
+
+    def get(self, name=None):
+        if name is None:
+            return self.default
+        return self.routes.get(name)
+
+    @property
+    def default(self):
+        return next(iter(self.routes.values()), None)
+
+    def __iter__(self):
+        return iter(self.routes.values())
+
+    def __len__(self):
+        return len(self.routes)
@@ -0,0 +1,33 @@
+import bisect
+import hashlib
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = _hash(f"{node}#{i}")
+            bisect.insort(self._keys, h)
+            self._nodes[h] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            h = _hash(f"{node}#{i}")
+            if self._nodes.pop(h, None) is not None:
+                self._keys.remove(h)
+
+    def node_for(self, key):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[self._keys[i]]
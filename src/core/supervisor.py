@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+from src.core.hub import hub
+from src.core.sharding import HashRing
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    def __init__(self, cfg, routes):
+        self.cfg = cfg
+        self.routes = routes
+        self.ctx = multiprocessing.get_context("spawn")
+        self.ring = HashRing(range(cfg["bridge_workers"]))
+        self.assignment = {route.name: self.ring.node_for(route.name) for route in routes}
+        self.inboxes = []
+        self.processes = []
+        self.events = self.ctx.Queue()
+        self.pump_task = None
+        self.handed_off = 0
+
+    def start(self):
+        for index in range(self.cfg["bridge_workers"]):
+            owned = [name for name, worker in self.assignment.items() if worker == index]
+            inbox = self.ctx.Queue(maxsize=self.cfg["outbound_queue_size"])
+            process = self.ctx.Process(
+                target=worker_main,
+                args=(index, self.cfg, owned, inbox, self.events),
+                name=f"bridge-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        self.pump_task = asyncio.create_task(self._pump())
+
+    async def handoff(self, platform, route, event):
+        inbox = self.inboxes[self.assignment[route.name]]
+        self.handed_off += 1
+        try:
+            inbox.put_nowait((platform, event))
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, inbox.put, (platform, event))
+
+    async def _pump(self):
+        # workers persist messages; replay them into this process's hub for live subscribers
+        loop = asyncio.get_running_loop()
+        while True:
+            doc = await loop.run_in_executor(None, self.events.get)
+            if doc is None:
+                return
+            hub.publish(doc)
+
+    async def stop(self, timeout=10):
+        loop = asyncio.get_running_loop()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not exit, terminating")
+                process.terminate()
+        self.events.put(None)
+        if self.pump_task:
+            await self.pump_task
+
+    def stats(self):
+        return {
+            "handed_off": self.handed_off,
+            "workers": [
+                {
+                    "index": index,
+                    "pid": process.pid,
+                    "alive": process.is_alive(),
+                    "routes": [name for name, worker in self.assignment.items() if worker == index],
+                }
+                for index, process in enumerate(self.processes)
+            ],
+        }
+
+
+def worker_main(index, cfg, owned, inbox, events):
+    asyncio.run(_run_worker(index, cfg, owned, inbox, events))
+
+
+async def _run_worker(index, cfg, owned, inbox, events):
+    import discord
+    from telegram.ext import Application
+    from src.bot.dc_bot import DiscordBot
+    from src.bot.tg_bot import TelegramBot
+    from src.core.forward import configure_threads, make_dispatcher, make_forwarders, make_outbox, make_sync, warm_media
+    from src.core.routes import RouteTable
+    from src.database import database, retention, store_functions
+    from src.utils import media
+
+    await database.init_store(cfg)
+    # setup() drops the TTL index when it gets none, so workers must pass the same one
+    await store_functions.configure(ttl=retention.native_ttl(cfg), delivery_grace=cfg["outbox_grace"])
+    store_functions.start_writer(cfg["write_batch_size"], cfg["write_flush_interval"])
+    store_functions.add_listener(events.put_nowait)
+
+    configure_threads(cfg)
+    routes = RouteTable.from_config(cfg)
+    for name in owned:
+        await routes.get(name).id_map.warm()
+
+    # REST-only clients: the gateway connections stay in the supervisor
+    tbot = Application.builder().token(cfg["telegram_token"]).updater(None).build()
+    await tbot.initialize()
+    dbot = discord.Client(intents=discord.Intents.none())
+    await dbot.login(cfg["discord_token"])
+
+    dispatcher = make_dispatcher(cfg)
+    await warm_media(cfg)
+    fwd_to_dd, forward_to_telegram = make_forwarders(tbot, dbot, dispatcher)
+    edit_on_discord, edit_on_telegram, delete_on_telegram = make_sync(tbot, dbot, dispatcher)
+    tg_bot_instance = TelegramBot(routes=routes, token=cfg["telegram_token"])
+    dc_bot_instance = DiscordBot(routes=routes)
+    tg_bot_instance.set_forward_callback(fwd_to_dd)
+    tg_bot_instance.set_sync_callbacks(edit_on_discord)
+    dc_bot_instance.set_forward_callback(forward_to_telegram)
+    dc_bot_instance.set_sync_callbacks(edit_on_telegram, delete_on_telegram)
+    # deliveries are tracked here; replaying them is left to the supervisor process
+    outbox = make_outbox(cfg)
+    tg_bot_instance.set_outbox(outbox)
+    dc_bot_instance.set_outbox(outbox)
+    handlers = {"telegram": tg_bot_instance, "discord": dc_bot_instance}
+    logger.info(f"Bridge worker {index} serving routes: {', '.join(owned) or '-'}")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item is None:
+                break
+            platform, event = item
+            try:
+                await handlers[platform].handle_event(routes.get(event["route"]), event)
+            except Exception:
+                logger.exception(f"Worker {index} failed to process {platform} event")
+    finally:
+        await tg_bot_instance.coalescer.close()
+        await dc_bot_instance.coalescer.close()
+        await dispatcher.close()
+        await outbox.close()
+        await media.close()
+        await store_functions.stop_writer()
+        await database.close_store()
+        await tbot.shutdown()
+        await dbot.close()
@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+from src.core import metrics
+from src.database import store_functions
+
+FIELDS = ("route", "tg_msg_id", "dc_msg_id", "reply_to_id")
+
+
+class ThreadCache:
+    def __init__(self, max_size=50000, ttl=604800, max_depth=50):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_depth = max_depth
+        # internal id -> ids on both platforms; the (route, platform id) indexes point into the same entries
+        self._entries = OrderedDict()
+        self._by_tg = {}
+        self._by_dc = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _drop(self, internal_id):
+        entry = self._entries.pop(internal_id, None)
+        if entry is None:
+            return
+        for index, field in ((self._by_tg, "tg_msg_id"), (self._by_dc, "dc_msg_id")):
+            if entry[field] is None:
+                continue
+            key = (entry["route"], int(entry[field]))
+            if index.get(key) == internal_id:
+                del index[key]
+
+    def _get(self, internal_id):
+        entry = self._entries.get(internal_id)
+        if entry is None:
+            return None
+        if entry["expires"] <= time.monotonic():
+            self._drop(internal_id)
+            return None
+        self._entries.move_to_end(internal_id)
+        return entry
+
+    def put(self, doc):
+        internal_id = doc.get("id") or doc.get("_id")
+        if internal_id is None:
+            return None
+        entry = self._entries.get(internal_id) or {"id": internal_id, **{f: None for f in FIELDS}}
+        for field in FIELDS:
+            if doc.get(field) is not None:
+                entry[field] = doc[field]
+        entry["expires"] = time.monotonic() + self.ttl
+        self._entries[internal_id] = entry
+        self._entries.move_to_end(internal_id)
+        if entry["tg_msg_id"] is not None:
+            self._by_tg[(entry["route"], int(entry["tg_msg_id"]))] = internal_id
+        if entry["dc_msg_id"] is not None:
+            self._by_dc[(entry["route"], int(entry["dc_msg_id"]))] = internal_id
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+        return entry
+
+    def update(self, internal_id, **fields):
+        # only refreshes what is cached; an unknown message is looked up properly on first use
+        if internal_id in self._entries:
+            self.put({"id": internal_id, **fields})
+
+    def cached(self, internal_id=None, tg_msg_id=None, dc_msg_id=None, route=None):
+        if internal_id is None and tg_msg_id is not None:
+            internal_id = self._by_tg.get((route, int(tg_msg_id)))
+        elif internal_id is None and dc_msg_id is not None:
+            internal_id = self._by_dc.get((route, int(dc_msg_id)))
+        return self._get(internal_id) if internal_id is not None else None
+
+    async def resolve(self, internal_id=None, tg_msg_id=None, dc_msg_id=None, route=None):
+        entry = self.cached(internal_id, tg_msg_id, dc_msg_id, route)
+        # a half-known entry may be waiting on a back-fill done elsewhere (a worker, the outbox), so re-read it
+        if entry is not None and entry["tg_msg_id"] is not None and entry["dc_msg_id"] is not None:
+            self.hits += 1
+            metrics.thread_lookups.labels("hit").inc()
+            return dict(entry)
+        self.misses += 1
+        metrics.thread_lookups.labels("miss").inc()
+        # one query brings in the whole ancestor chain, so replies deeper in the conversation hit the cache
+        chain = await store_functions.thread_ancestors(internal_id, tg_msg_id, dc_msg_id, route, self.max_depth)
+        entries = [self.put(doc) for doc in chain]
+        return dict(entries[0]) if entries else None
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def nest(docs):
+    nodes = {d["id"]: {**d, "replies": []} for d in docs}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node.get("reply_to_id"))
+        if parent is not None and parent is not node:
+            parent["replies"].append(node)
+        else:
+            # the root, or a reply whose parent has been deleted or expired
+            roots.append(node)
+    return roots
+
+
+threads = ThreadCache()
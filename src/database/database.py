@@ -1,21 +1,47 @@
-from motor.motor_asyncio import AsyncIOMotorClient
-
 client = None
 db = None
+store = None
 
-async def init_db(mongo_uri, mongo_db):
+async def init_db(mongo_uri, mongo_db, **client_options):
     global client, db
+    # imported here so the SQLite and in-memory stores run without the Mongo driver
+    from motor.motor_asyncio import AsyncIOMotorClient
     try:
-        client = AsyncIOMotorClient(mongo_uri)
+        client = AsyncIOMotorClient(mongo_uri, **client_options)
         await client.admin.command('ping')
         db = client[mongo_db]
         return db
     except Exception as e:
         raise
 
+async def init_store(cfg):
+    global store
+    backend = cfg.get("storage_backend", "mongo")
+    if backend == "sqlite":
+        from src.database.sqlite_store import SQLiteStore
+        store = SQLiteStore(cfg["sqlite_path"])
+    elif backend == "memory":
+        from src.database.memory_store import MemoryStore
+        store = MemoryStore()
+    else:
+        from src.database.mongo_store import MongoStore, client_options
+        store = MongoStore(
+            write_w=cfg.get("mongo_write_w", 1),
+            write_journal=cfg.get("mongo_write_journal", False),
+            read_preference=cfg.get("mongo_read_preference", "primary"),
+        )
+        await init_db(cfg["mongo_uri"], cfg["mongo_db"], **client_options(cfg, store.pool))
+    return store
+
+async def close_store():
+    if store is not None:
+        await store.close()
+
 def get_db():
     return db
 
 def get_client():
     return client
 
+def get_store():
+    return store
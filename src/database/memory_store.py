@@ -0,0 +1,234 @@
+import bisect
+import copy
+import re
+from collections import defaultdict
+
+WORD = re.compile(r"\w+")
+SEARCH_WEIGHTS = {"text": 10, "username": 1}
+
+
+def tokens(text):
+    return WORD.findall((text or "").lower())
+
+
+def matches(doc, criteria):
+    if criteria.get("route") is not None and doc.get("route") != criteria["route"]:
+        return False
+    if criteria.get("source") and doc.get("source") != criteria["source"]:
+        return False
+    if criteria.get("username") and doc.get("username") != criteria["username"]:
+        return False
+    if criteria.get("since") is not None and doc["timestamp"] < float(criteria["since"]):
+        return False
+    if criteria.get("until") is not None and doc["timestamp"] >= float(criteria["until"]):
+        return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+    return {k: v for k, v in doc.items() if k == "_id" or projection.get(k)}
+
+
+class MemoryStore:
+    name = "memory"
+
+    def __init__(self):
+        self.docs = {}
+        # (timestamp, _id) in ascending order, the same key the API cursors use
+        self.order = []
+        self.by_tg = defaultdict(set)
+        self.by_dc = defaultdict(set)
+        self.replies = defaultdict(set)
+        self.postings = defaultdict(dict)
+
+    def _index(self, doc):
+        if doc.get("tg_msg_id") is not None:
+            self.by_tg[doc["tg_msg_id"]].add(doc["_id"])
+        if doc.get("dc_msg_id") is not None:
+            self.by_dc[doc["dc_msg_id"]].add(doc["_id"])
+        if doc.get("reply_to_id") is not None:
+            self.replies[doc["reply_to_id"]].add(doc["_id"])
+        for field, weight in SEARCH_WEIGHTS.items():
+            for token in tokens(doc.get(field)):
+                entry = self.postings[token]
+                entry[doc["_id"]] = entry.get(doc["_id"], 0) + weight
+
+    def _unindex(self, doc):
+        self.by_tg.get(doc.get("tg_msg_id"), set()).discard(doc["_id"])
+        self.by_dc.get(doc.get("dc_msg_id"), set()).discard(doc["_id"])
+        self.replies.get(doc.get("reply_to_id"), set()).discard(doc["_id"])
+        for field in SEARCH_WEIGHTS:
+            for token in tokens(doc.get(field)):
+                entry = self.postings.get(token)
+                if entry is not None:
+                    entry.pop(doc["_id"], None)
+                    if not entry:
+                        del self.postings[token]
+
+    def _put(self, doc):
+        old = self.docs.get(doc["_id"])
+        if old is not None:
+            self._unindex(old)
+            self.order.pop(bisect.bisect_left(self.order, (old["timestamp"], old["_id"])))
+        self.docs[doc["_id"]] = doc
+        bisect.insort(self.order, (doc["timestamp"], doc["_id"]))
+        self._index(doc)
+
+    def _match_one(self, filter_):
+        if "_id" in filter_:
+            return self.docs.get(filter_["_id"])
+        field = "tg_msg_id" if "tg_msg_id" in filter_ else "dc_msg_id"
+        index = self.by_tg if field == "tg_msg_id" else self.by_dc
+        found = [self.docs[i] for i in index.get(filter_[field], ())]
+        found = [d for d in found if "route" not in filter_ or d.get("route") == filter_["route"]]
+        return min(found, key=lambda d: (d["timestamp"], d["_id"]), default=None)
+
+    async def setup(self, default_route=None, ttl=None):
+        if default_route:
+            for doc in self.docs.values():
+                doc.setdefault("route", default_route)
+
+    async def write(self, docs, ops):
+        # copies: the write-behind buffer may still touch the dicts it handed over
+        for doc in docs:
+            self._put(copy.deepcopy(doc))
+        for filter_, _, local in ops:
+            doc = self._match_one(filter_)
+            if doc is not None:
+                self._unindex(doc)
+                local(doc)
+                self._index(doc)
+        return len(docs) + len(ops)
+
+    async def get(self, internal_id):
+        doc = self.docs.get(internal_id)
+        return copy.deepcopy(doc) if doc else None
+
+    async def find_one(self, filter_):
+        doc = self._match_one(filter_)
+        return copy.deepcopy(doc) if doc else None
+
+    def _walk(self, order, after):
+        if order == -1:
+            end = bisect.bisect_left(self.order, tuple(after)) if after else len(self.order)
+            keys = reversed(self.order[:end])
+        else:
+            start = bisect.bisect_right(self.order, tuple(after)) if after else 0
+            keys = self.order[start:]
+        for _, internal_id in keys:
+            yield self.docs[internal_id]
+
+    async def find(self, criteria, order=-1, after=None, limit=50, offset=0, projection=None):
+        found = []
+        for doc in self._walk(order, after):
+            if not matches(doc, criteria):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            found.append(copy.deepcopy(project(doc, projection)))
+            if len(found) >= limit:
+                break
+        return found
+
+    async def iterate(self, criteria, after=None, projection=None, batch_size=1000):
+        for doc in list(self._walk(1, after)):
+            if matches(doc, criteria):
+                yield copy.deepcopy(project(doc, projection))
+
+    async def search(self, q, criteria, sort="relevance", after=None, limit=50, projection=None):
+        scores = defaultdict(float)
+        for token in set(tokens(q)):
+            for internal_id, weight in self.postings.get(token, {}).items():
+                scores[internal_id] += weight
+
+        def key(internal_id):
+            doc = self.docs[internal_id]
+            if sort == "relevance":
+                return scores[internal_id], doc["timestamp"], internal_id
+            return doc["timestamp"], internal_id
+
+        ranked = sorted((i for i in scores if matches(self.docs[i], criteria)), key=key, reverse=True)
+        if after:
+            ranked = [i for i in ranked if key(i) < tuple(after)]
+        return [
+            {**copy.deepcopy(project(self.docs[i], projection)), "score": scores[i]}
+            for i in ranked[:limit]
+        ]
+
+    async def id_pairs(self, route=None, limit=50000):
+        pairs = []
+        for doc in self._walk(-1, None):
+            if doc.get("tg_msg_id") is None or doc.get("dc_msg_id") is None:
+                continue
+            if route is not None and doc.get("route") != route:
+                continue
+            pairs.append({"tg_msg_id": doc["tg_msg_id"], "dc_msg_id": doc["dc_msg_id"]})
+            if len(pairs) >= limit:
+                break
+        return pairs
+
+    async def ancestors(self, filter_, max_depth=50):
+        chain = []
+        doc = self._match_one(filter_)
+        while doc is not None and len(chain) <= max_depth:
+            chain.append(copy.deepcopy(doc))
+            doc = self.docs.get(doc.get("reply_to_id"))
+        return chain
+
+    async def thread(self, internal_id, max_depth=50):
+        root = self.docs.get(internal_id)
+        if root is None:
+            return []
+        chain = {root["_id"]}
+        for _ in range(max_depth):
+            parent = self.docs.get(root.get("reply_to_id"))
+            if parent is None or parent["_id"] in chain:
+                break
+            root = parent
+            chain.add(root["_id"])
+        found = {root["_id"]}
+        level = [root["_id"]]
+        for _ in range(max_depth + 1):
+            level = [r for i in level for r in self.replies.get(i, ()) if r not in found]
+            found.update(level)
+        found |= chain
+        docs = sorted((self.docs[i] for i in found if i in self.docs), key=lambda d: (d["timestamp"], d["_id"]))
+        return [copy.deepcopy(d) for d in docs]
+
+    async def due(self, now, limit=100):
+        found = []
+        for doc in self.docs.values():
+            delivery = doc.get("delivery") or {}
+            if any(d.get("state") == "pending" and d.get("next_at", 0) <= now for d in delivery.values()):
+                found.append(copy.deepcopy(doc))
+                if len(found) >= limit:
+                    break
+        return found
+
+    async def oldest(self, cutoff, limit=1000):
+        found = []
+        for doc in self._walk(1, None):
+            if doc["timestamp"] >= cutoff or len(found) >= limit:
+                break
+            found.append(copy.deepcopy(doc))
+        return found
+
+    async def remove(self, ids):
+        removed = 0
+        for internal_id in ids:
+            doc = self.docs.pop(internal_id, None)
+            if doc is None:
+                continue
+            self._unindex(doc)
+            self.order.pop(bisect.bisect_left(self.order, (doc["timestamp"], doc["_id"])))
+            removed += 1
+        return removed
+
+    def stats(self):
+        return {"documents": len(self.docs), "terms": len(self.postings)}
+
+    async def close(self):
+        pass
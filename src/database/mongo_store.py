@@ -0,0 +1,349 @@
+import threading
+from datetime import datetime, timezone
+from pymongo import ReplaceOne, UpdateOne, WriteConcern
+from pymongo.errors import OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from src.core import metrics
+from src.database.database import get_db
+
+# created_at is a real date for the TTL index; the API keeps using the float timestamp
+HIDDEN = {"created_at": 0}
+THREAD_HIDDEN = {"created_at": 0, "ancestors.created_at": 0, "replies.created_at": 0, "root": 0}
+INDEX_OPTIONS_CONFLICT = 85
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+class PoolStats(ConnectionPoolListener):
+    # pymongo calls these from its own threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "open": 0,
+            "checked_out": 0,
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "cleared": 0,
+        }
+        self.max_checked_out = 0
+
+    def _bump(self, address, **deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                self.counters[key] += delta
+            self.max_checked_out = max(self.max_checked_out, self.counters["checked_out"])
+        host = f"{address[0]}:{address[1]}" if address else "-"
+        metrics.mongo_pool_open.labels(host).set(self.counters["open"])
+        metrics.mongo_pool_checked_out.labels(host).set(self.counters["checked_out"])
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump(event.address, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump(event.address, created=1, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump(event.address, closed=1, open=-1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        metrics.mongo_pool_checkout_failures.labels(str(event.reason)).inc()
+        self._bump(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._bump(event.address, checkouts=1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._bump(event.address, checked_out=-1)
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "max_checked_out": self.max_checked_out}
+
+
+def client_options(cfg, pool_listener=None):
+    options = {
+        "maxPoolSize": cfg.get("mongo_max_pool_size", 100),
+        "minPoolSize": cfg.get("mongo_min_pool_size", 0),
+        "connectTimeoutMS": cfg.get("mongo_connect_timeout_ms", 20000),
+        "serverSelectionTimeoutMS": cfg.get("mongo_server_selection_timeout_ms", 30000),
+    }
+    if cfg.get("mongo_max_idle_ms"):
+        options["maxIdleTimeMS"] = cfg["mongo_max_idle_ms"]
+    if cfg.get("mongo_compressors"):
+        # zstd needs the zstandard package, snappy needs python-snappy
+        options["compressors"] = cfg["mongo_compressors"]
+    if pool_listener:
+        options["event_listeners"] = [pool_listener]
+    return options
+
+
+def mongo_query(criteria):
+    query = {}
+    if criteria.get("route") is not None:
+        query["route"] = criteria["route"]
+    if criteria.get("source"):
+        query["source"] = criteria["source"]
+    if criteria.get("username"):
+        query["username"] = criteria["username"]
+    if criteria.get("since") is not None or criteria.get("until") is not None:
+        query["timestamp"] = {}
+        if criteria.get("since") is not None:
+            query["timestamp"]["$gte"] = float(criteria["since"])
+        if criteria.get("until") is not None:
+            query["timestamp"]["$lt"] = float(criteria["until"])
+    return query
+
+
+def ancestors_lookup(max_depth):
+    return {"$graphLookup": {
+        "from": "messages",
+        "startWith": "$reply_to_id",
+        "connectFromField": "reply_to_id",
+        "connectToField": "_id",
+        "as": "ancestors",
+        "maxDepth": max_depth,
+        "depthField": "depth",
+    }}
+
+
+def keyset(keys, values, op):
+    # (k1 op v1) or (k1 == v1 and k2 op v2) or ...
+    return {"$or": [
+        {**{k: v for k, v in zip(keys[:i], values)}, keys[i]: {op: values[i]}}
+        for i in range(len(keys))
+    ]}
+
+
+class MongoStore:
+    name = "mongo"
+
+    def __init__(self, write_w=1, write_journal=False, read_preference="primary"):
+        self.write_concern = WriteConcern(w=write_w, j=write_journal)
+        self.read_preference = READ_PREFERENCES[read_preference]()
+        self.pool = PoolStats()
+
+    @property
+    def col(self):
+        return get_db()["messages"]
+
+    @property
+    def writes(self):
+        # hot path: the bridge writes through the write-behind buffer, so ack latency matters more than durability
+        return self.col.with_options(write_concern=self.write_concern)
+
+    @property
+    def history(self):
+        # listing, search, export and warm-up tolerate replica lag; point lookups stay on the primary
+        return self.col.with_options(read_preference=self.read_preference)
+
+    async def setup(self, default_route=None, ttl=None):
+        col = self.col
+        await col.create_index("timestamp")
+        await col.create_index([("timestamp", -1), ("_id", -1)])
+        await col.create_index("tg_msg_id", sparse=True)
+        await col.create_index("dc_msg_id", sparse=True)
+        await col.create_index([("route", 1), ("tg_msg_id", 1)])
+        await col.create_index([("route", 1), ("dc_msg_id", 1)])
+        await col.create_index("reply_to_id")
+        # chats mix languages, so no stemming or stop words
+        await col.create_index(
+            [("text", "text"), ("username", "text")],
+            name="text_search",
+            weights={"text": 10, "username": 1},
+            default_language="none",
+        )
+        if default_route:
+            # documents written before routing existed belong to the first route
+            await col.update_many({"route": {"$exists": False}}, {"$set": {"route": default_route}})
+        for platform in ("telegram", "discord"):
+            # partial: only undelivered entries are indexed, so the outbox index stays tiny
+            await col.create_index(
+                f"delivery.{platform}.next_at",
+                name=f"outbox_{platform}",
+                partialFilterExpression={f"delivery.{platform}.state": "pending"},
+            )
+        if ttl:
+            await self._setup_ttl(col, ttl)
+        elif "retention_ttl" in await col.index_information():
+            await col.drop_index("retention_ttl")
+
+    async def _setup_ttl(self, col, ttl):
+        await col.update_many(
+            {"created_at": {"$exists": False}},
+            [{"$set": {"created_at": {"$toDate": {"$multiply": ["$timestamp", 1000]}}}}],
+        )
+        try:
+            await col.create_index("created_at", name="retention_ttl", expireAfterSeconds=ttl)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # the retention period changed since the index was built
+            await get_db().command("collMod", "messages", index={"name": "retention_ttl", "expireAfterSeconds": ttl})
+
+    async def write(self, docs, ops):
+        requests = [
+            UpdateOne(
+                {"_id": doc["_id"]},
+                {
+                    "$set": {k: v for k, v in doc.items() if k != "_id"},
+                    "$setOnInsert": {"created_at": datetime.fromtimestamp(doc["timestamp"], timezone.utc)},
+                },
+                upsert=True,
+            )
+            for doc in docs
+        ]
+        requests.extend(UpdateOne(filter_, update) for filter_, update, _ in ops)
+        await self.writes.bulk_write(requests, ordered=True)
+        return len(requests)
+
+    async def get(self, internal_id):
+        return await self.col.find_one({"_id": internal_id}, HIDDEN)
+
+    async def find_one(self, filter_):
+        return await self.col.find_one(filter_, HIDDEN)
+
+    def _cursor(self, criteria, order, after, projection, skip=0, batch_size=None):
+        query = mongo_query(criteria)
+        if after:
+            query.update(keyset(["timestamp", "_id"], after, "$lt" if order == -1 else "$gt"))
+        kwargs = {"batch_size": batch_size} if batch_size else {}
+        return self.history.find(
+            query,
+            projection=projection or HIDDEN,
+            sort=[("timestamp", order), ("_id", order)],
+            skip=skip,
+            **kwargs,
+        )
+
+    async def find(self, criteria, order=-1, after=None, limit=50, offset=0, projection=None):
+        return await self._cursor(criteria, order, after, projection, skip=offset).to_list(length=limit)
+
+    async def iterate(self, criteria, after=None, projection=None, batch_size=1000):
+        async for d in self._cursor(criteria, 1, after, projection, batch_size=batch_size):
+            yield d
+
+    async def search(self, q, criteria, sort="relevance", after=None, limit=50, projection=None):
+        query = mongo_query(criteria)
+        query["$text"] = {"$search": q}
+        pipeline = [{"$match": query}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+        keys = ["score", "timestamp", "_id"] if sort == "relevance" else ["timestamp", "_id"]
+        if after:
+            pipeline.append({"$match": keyset(keys, after, "$lt")})
+        pipeline.append({"$sort": {k: -1 for k in keys}})
+        pipeline.append({"$limit": limit})
+        pipeline.append({"$project": {**projection, "score": 1} if projection else HIDDEN})
+        return await self.history.aggregate(pipeline).to_list(length=limit)
+
+    async def id_pairs(self, route=None, limit=50000):
+        query = {"tg_msg_id": {"$ne": None}, "dc_msg_id": {"$ne": None}}
+        if route is not None:
+            query["route"] = route
+        cursor = self.history.find(
+            query,
+            projection={"_id": 0, "tg_msg_id": 1, "dc_msg_id": 1},
+            sort=[("timestamp", -1)],
+        )
+        return await cursor.to_list(length=limit)
+
+    async def ancestors(self, filter_, max_depth=50):
+        pipeline = [
+            {"$match": filter_},
+            {"$sort": {"timestamp": 1, "_id": 1}},
+            {"$limit": 1},
+            ancestors_lookup(max_depth),
+            {"$project": THREAD_HIDDEN},
+        ]
+        found = await self.col.aggregate(pipeline).to_list(length=1)
+        if not found:
+            return []
+        doc = found[0]
+        chain = sorted(doc.pop("ancestors"), key=lambda d: d.pop("depth"))
+        return [doc] + chain
+
+    async def thread(self, internal_id, max_depth=50):
+        pipeline = [
+            {"$match": {"_id": internal_id}},
+            ancestors_lookup(max_depth),
+            # the root is the furthest ancestor reached, or the message itself
+            {"$addFields": {"root": {"$reduce": {
+                "input": "$ancestors",
+                "initialValue": {"depth": -1, "_id": "$_id"},
+                "in": {"$cond": [{"$gt": ["$$this.depth", "$$value.depth"]}, {"depth": "$$this.depth", "_id": "$$this._id"}, "$$value"]},
+            }}}},
+            {"$graphLookup": {
+                "from": "messages",
+                "startWith": "$root._id",
+                "connectFromField": "_id",
+                "connectToField": "reply_to_id",
+                "as": "replies",
+                "maxDepth": max_depth,
+            }},
+            {"$project": THREAD_HIDDEN},
+        ]
+        found = await self.col.aggregate(pipeline).to_list(length=1)
+        if not found:
+            return []
+        doc = found[0]
+        docs = {d["_id"]: d for d in doc.pop("ancestors") + doc.pop("replies")}
+        docs[doc["_id"]] = doc
+        for d in docs.values():
+            d.pop("depth", None)
+        return sorted(docs.values(), key=lambda d: (d["timestamp"], d["_id"]))
+
+    async def due(self, now, limit=100):
+        query = {"$or": [
+            {f"delivery.{p}.state": "pending", f"delivery.{p}.next_at": {"$lte": now}}
+            for p in ("telegram", "discord")
+        ]}
+        return await self.col.find(query, HIDDEN).to_list(length=limit)
+
+    async def oldest(self, cutoff, limit=1000):
+        cursor = self.col.find({"timestamp": {"$lt": cutoff}}, HIDDEN, sort=[("timestamp", 1), ("_id", 1)])
+        return await cursor.to_list(length=limit)
+
+    async def archive(self, docs):
+        by_month = {}
+        for doc in docs:
+            month = datetime.fromtimestamp(doc["timestamp"], timezone.utc).strftime("%Y_%m")
+            by_month.setdefault(month, []).append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+        # replaces keep a re-run after a crash between archive and remove idempotent
+        for month, requests in by_month.items():
+            await get_db()[f"messages_archive_{month}"].bulk_write(requests, ordered=False)
+
+    async def remove(self, ids):
+        result = await self.writes.delete_many({"_id": {"$in": list(ids)}})
+        return result.deleted_count
+
+    def stats(self):
+        return {
+            "write_concern": self.write_concern.document,
+            "history_read_preference": self.read_preference.mongos_mode,
+            "pool": self.pool.stats(),
+        }
+
+    async def close(self):
+        pass
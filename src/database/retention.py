@@ -0,0 +1,56 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from src.database.database import get_store
+
+logger = logging.getLogger(__name__)
+
+
+def native_ttl(cfg):
+    # Mongo expires documents itself in ttl mode; everything else needs the sweeper
+    if cfg["storage_backend"] == "mongo" and cfg["retention_mode"] == "ttl":
+        return int(cfg["retention_days"] * 86400) or None
+    return None
+
+
+def _append_ndjson(archive_dir, docs):
+    os.makedirs(archive_dir, exist_ok=True)
+    by_month = {}
+    for doc in docs:
+        month = datetime.fromtimestamp(doc["timestamp"], timezone.utc).strftime("%Y-%m")
+        by_month.setdefault(month, []).append(doc)
+    for month, items in by_month.items():
+        # each append is a new gzip member; gzip readers treat the file as one stream
+        with gzip.open(os.path.join(archive_dir, f"messages-{month}.ndjson.gz"), "at", encoding="utf-8") as f:
+            for doc in items:
+                f.write(json.dumps(doc, default=str) + "\n")
+
+
+async def sweep(mode, max_age, archive_dir="archive", batch_size=1000):
+    store = get_store()
+    cutoff = time.time() - max_age
+    moved = 0
+    while True:
+        docs = await store.oldest(cutoff, limit=batch_size)
+        if not docs:
+            return moved
+        if mode == "collection":
+            await store.archive(docs)
+        elif mode == "ndjson":
+            await asyncio.to_thread(_append_ndjson, archive_dir, docs)
+        moved += await store.remove([d["_id"] for d in docs])
+
+
+async def run(mode, max_age, archive_dir="archive", interval=3600, batch_size=1000):
+    while True:
+        try:
+            moved = await sweep(mode, max_age, archive_dir, batch_size)
+            if moved:
+                logger.info(f"Retention ({mode}) removed {moved} messages older than {max_age}s")
+        except Exception:
+            logger.exception("Retention sweep failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from src.database.memory_store import project
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    route TEXT,
+    source TEXT,
+    username TEXT,
+    timestamp REAL NOT NULL,
+    tg_msg_id INTEGER,
+    dc_msg_id INTEGER,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (timestamp, id);
+CREATE INDEX IF NOT EXISTS messages_tg ON messages (tg_msg_id);
+CREATE INDEX IF NOT EXISTS messages_dc ON messages (dc_msg_id);
+CREATE INDEX IF NOT EXISTS messages_route_tg ON messages (route, tg_msg_id);
+CREATE INDEX IF NOT EXISTS messages_route_dc ON messages (route, dc_msg_id);
+CREATE INDEX IF NOT EXISTS messages_reply ON messages (json_extract(doc, '$.reply_to_id'));
+CREATE INDEX IF NOT EXISTS outbox_telegram ON messages (json_extract(doc, '$.delivery.telegram.next_at'))
+    WHERE json_extract(doc, '$.delivery.telegram.state') = 'pending';
+CREATE INDEX IF NOT EXISTS outbox_discord ON messages (json_extract(doc, '$.delivery.discord.next_at'))
+    WHERE json_extract(doc, '$.delivery.discord.state') = 'pending';
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, username, tokenize='unicode61');
+"""
+
+UPSERT = """
+INSERT INTO messages (id, route, source, username, timestamp, tg_msg_id, dc_msg_id, doc)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    route = excluded.route,
+    source = excluded.source,
+    username = excluded.username,
+    timestamp = excluded.timestamp,
+    tg_msg_id = excluded.tg_msg_id,
+    dc_msg_id = excluded.dc_msg_id,
+    doc = excluded.doc
+"""
+
+# walks reply_to_id up from a message; depth bounds it even if the data holds a cycle
+ANCESTORS = """
+WITH RECURSIVE up(id, depth) AS (
+    SELECT ?, 0
+    UNION ALL
+    SELECT json_extract(m.doc, '$.reply_to_id'), up.depth + 1
+    FROM up JOIN messages m ON m.id = up.id
+    WHERE up.depth < ?
+)
+"""
+
+THREAD = ANCESTORS + """,
+root(id) AS (
+    SELECT up.id FROM up JOIN messages m ON m.id = up.id ORDER BY up.depth DESC LIMIT 1
+),
+down(id, depth) AS (
+    SELECT id, 0 FROM root
+    UNION ALL
+    SELECT m.id, down.depth + 1
+    FROM down JOIN messages m ON json_extract(m.doc, '$.reply_to_id') = down.id
+    WHERE down.depth < ?
+)
+SELECT doc FROM messages WHERE id IN (SELECT id FROM up UNION SELECT id FROM down) ORDER BY timestamp, id
+"""
+
+# filter/criteria keys map straight onto columns
+COLUMNS = {"_id": "id", "route": "route", "tg_msg_id": "tg_msg_id", "dc_msg_id": "dc_msg_id"}
+WORD = re.compile(r"\w+")
+
+
+def where(criteria):
+    clauses, params = [], []
+    if criteria.get("route") is not None:
+        clauses.append("route = ?")
+        params.append(criteria["route"])
+    for key in ("source", "username"):
+        if criteria.get(key):
+            clauses.append(f"{key} = ?")
+            params.append(criteria[key])
+    if criteria.get("since") is not None:
+        clauses.append("timestamp >= ?")
+        params.append(float(criteria["since"]))
+    if criteria.get("until") is not None:
+        clauses.append("timestamp < ?")
+        params.append(float(criteria["until"]))
+    return clauses, params
+
+
+class SQLiteStore:
+    name = "sqlite"
+
+    def __init__(self, path="bindsync.db"):
+        self.path = path
+        self.conn = None
+        # one thread owns the connection, so statements never interleave
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _open(self, default_route):
+        self.conn = sqlite3.connect(self.path, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        if default_route:
+            rows = self.conn.execute("SELECT doc FROM messages WHERE route IS NULL").fetchall()
+            with self.conn:
+                for (raw,) in rows:
+                    doc = json.loads(raw)
+                    doc["route"] = default_route
+                    self._upsert(self._row(doc), doc)
+
+    async def setup(self, default_route=None, ttl=None):
+        if self.conn is None:
+            await self._run(self._open, default_route)
+
+    def _row(self, doc):
+        return (
+            doc["_id"],
+            doc.get("route"),
+            doc.get("source"),
+            doc.get("username"),
+            doc["timestamp"],
+            doc.get("tg_msg_id"),
+            doc.get("dc_msg_id"),
+            json.dumps(doc),
+        )
+
+    def _upsert(self, row, doc):
+        self.conn.execute(UPSERT, row)
+        (rowid,) = self.conn.execute("SELECT rowid FROM messages WHERE id = ?", (row[0],)).fetchone()
+        self.conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (rowid,))
+        self.conn.execute(
+            "INSERT INTO messages_fts (rowid, text, username) VALUES (?, ?, ?)",
+            (rowid, doc.get("text") or "", doc.get("username") or ""),
+        )
+
+    def _match_one(self, filter_):
+        clauses = [f"{COLUMNS[k]} = ?" for k in filter_]
+        row = self.conn.execute(
+            f"SELECT doc FROM messages WHERE {' AND '.join(clauses)} ORDER BY timestamp, id LIMIT 1",
+            list(filter_.values()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, rows, ops):
+        # one transaction per flush
+        with self.conn:
+            for row, doc in rows:
+                self._upsert(row, doc)
+            for filter_, _, local in ops:
+                doc = self._match_one(filter_)
+                if doc is not None:
+                    local(doc)
+                    self._upsert(self._row(doc), doc)
+
+    async def write(self, docs, ops):
+        # serialise on the loop thread: the write-behind buffer may still touch these dicts
+        rows = [(self._row(doc), json.loads(json.dumps(doc))) for doc in docs]
+        await self._run(self._write, rows, ops)
+        return len(rows) + len(ops)
+
+    async def get(self, internal_id):
+        return await self._run(self._match_one, {"_id": internal_id})
+
+    async def find_one(self, filter_):
+        return await self._run(self._match_one, filter_)
+
+    def _find(self, criteria, order, after, limit, offset, projection):
+        clauses, params = where(criteria)
+        if after:
+            clauses.append(f"(timestamp, id) {'<' if order == -1 else '>'} (?, ?)")
+            params.extend(after)
+        direction = "DESC" if order == -1 else "ASC"
+        sql = "SELECT doc FROM messages"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY timestamp {direction}, id {direction} LIMIT ? OFFSET ?"
+        rows = self.conn.execute(sql, params + [limit, offset]).fetchall()
+        return [project(json.loads(raw), projection) for (raw,) in rows]
+
+    async def find(self, criteria, order=-1, after=None, limit=50, offset=0, projection=None):
+        return await self._run(self._find, criteria, order, after, limit, offset, projection)
+
+    async def iterate(self, criteria, after=None, projection=None, batch_size=1000):
+        while True:
+            page = await self._run(self._find, criteria, 1, after, batch_size, 0, projection)
+            for doc in page:
+                yield doc
+            if len(page) < batch_size:
+                return
+            after = (page[-1]["timestamp"], page[-1]["_id"])
+
+    def _search(self, q, criteria, sort, after, limit, projection):
+        terms = WORD.findall(q)
+        if not terms:
+            return []
+        clauses, params = where(criteria)
+        clauses = [f"m.{c}" for c in clauses]
+        sql = (
+            "SELECT m.doc, -bm25(messages_fts, 10.0, 1.0) AS score, m.timestamp, m.id"
+            " FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid"
+            " WHERE messages_fts MATCH ?"
+        )
+        params = [" OR ".join(f'"{t}"' for t in terms)] + params
+        if clauses:
+            sql += " AND " + " AND ".join(clauses)
+        keys = "score, timestamp, id" if sort == "relevance" else "timestamp, id"
+        sql = f"SELECT doc, score FROM ({sql})"
+        if after:
+            sql += f" WHERE ({keys}) < ({', '.join('?' for _ in after)})"
+            params.extend(after)
+        sql += " ORDER BY " + ", ".join(f"{k} DESC" for k in keys.split(", ")) + " LIMIT ?"
+        rows = self.conn.execute(sql, params + [limit]).fetchall()
+        return [{**project(json.loads(raw), projection), "score": score} for raw, score in rows]
+
+    async def search(self, q, criteria, sort="relevance", after=None, limit=50, projection=None):
+        return await self._run(self._search, q, criteria, sort, after, limit, projection)
+
+    def _id_pairs(self, route, limit):
+        sql = "SELECT tg_msg_id, dc_msg_id FROM messages WHERE tg_msg_id IS NOT NULL AND dc_msg_id IS NOT NULL"
+        params = []
+        if route is not None:
+            sql += " AND route = ?"
+            params.append(route)
+        sql += " ORDER BY timestamp DESC LIMIT ?"
+        rows = self.conn.execute(sql, params + [limit]).fetchall()
+        return [{"tg_msg_id": tg, "dc_msg_id": dc} for tg, dc in rows]
+
+    async def id_pairs(self, route=None, limit=50000):
+        return await self._run(self._id_pairs, route, limit)
+
+    def _ancestors(self, filter_, max_depth):
+        first = self._match_one(filter_)
+        if first is None:
+            return []
+        rows = self.conn.execute(
+            ANCESTORS + "SELECT m.doc FROM up JOIN messages m ON m.id = up.id WHERE up.depth > 0 ORDER BY up.depth",
+            (first["_id"], max_depth),
+        ).fetchall()
+        return [first] + [json.loads(raw) for (raw,) in rows]
+
+    async def ancestors(self, filter_, max_depth=50):
+        return await self._run(self._ancestors, filter_, max_depth)
+
+    def _thread(self, internal_id, max_depth):
+        rows = self.conn.execute(THREAD, (internal_id, max_depth, max_depth)).fetchall()
+        return [json.loads(raw) for (raw,) in rows]
+
+    async def thread(self, internal_id, max_depth=50):
+        return await self._run(self._thread, internal_id, max_depth)
+
+    def _due(self, now, limit):
+        found = {}
+        for platform in ("telegram", "discord"):
+            # written to match the partial index definitions above
+            rows = self.conn.execute(
+                f"SELECT id, doc FROM messages"
+                f" WHERE json_extract(doc, '$.delivery.{platform}.state') = 'pending'"
+                f" AND json_extract(doc, '$.delivery.{platform}.next_at') <= ?"
+                f" LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            for internal_id, raw in rows:
+                found.setdefault(internal_id, json.loads(raw))
+        return list(found.values())[:limit]
+
+    async def due(self, now, limit=100):
+        return await self._run(self._due, now, limit)
+
+    def _oldest(self, cutoff, limit):
+        rows = self.conn.execute(
+            "SELECT doc FROM messages WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?",
+            (cutoff, limit),
+        ).fetchall()
+        return [json.loads(raw) for (raw,) in rows]
+
+    async def oldest(self, cutoff, limit=1000):
+        return await self._run(self._oldest, cutoff, limit)
+
+    def _remove(self, ids):
+        removed = 0
+        with self.conn:
+            for internal_id in ids:
+                row = self.conn.execute("SELECT rowid FROM messages WHERE id = ?", (internal_id,)).fetchone()
+                if row is None:
+                    continue
+                self.conn.execute("DELETE FROM messages_fts WHERE rowid = ?", row)
+                self.conn.execute("DELETE FROM messages WHERE rowid = ?", row)
+                removed += 1
+        return removed
+
+    async def remove(self, ids):
+        return await self._run(self._remove, list(ids))
+
+    def stats(self):
+        return {"path": self.path}
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def close(self):
+        await self._run(self._close)
+        self.executor.shutdown(wait=False)
@@ -1,6 +1,36 @@
+import asyncio
+import base64
+import json
+import logging
 import time
 import uuid
-from src.database.database import get_db
+from src.core.metrics import timed
+from src.database.database import get_store
+
+logger = logging.getLogger(__name__)
+
+# write-behind buffer: documents and id back-fills waiting for the next bulk_write
+_pending = {}
+_pending_tg = {}
+_pending_dc = {}
+_pending_ops = []
+_inflight = {}
+_flush_lock = asyncio.Lock()
+_wake = None
+_writer_task = None
+_batch_size = 100
+_flush_interval = 0.5
+_listeners = []
+# a fresh delivery belongs to the live send path for this long before the outbox may replay it
+_delivery_grace = 120.0
+PLATFORM_ID_FIELDS = {"telegram": "tg_msg_id", "discord": "dc_msg_id"}
+
+MESSAGE_FIELDS = {
+    "route", "source", "text", "username", "timestamp", "tg_msg_id", "dc_msg_id",
+    "reply_to_id", "reply_to_tg_id", "reply_to_dc_id", "attachments",
+    "edited_at", "history", "deleted", "deleted_at", "delivery",
+}
+
 
 def api_shape(d):
     if not d:
@@ -10,19 +40,167 @@ def api_shape(d):
     return d
 
 
-async def configure():
-    db = get_db()
-    col = db["messages"]
-    await col.create_index("timestamp")
-    await col.create_index("tg_msg_id", sparse=True)
-    await col.create_index("dc_msg_id", sparse=True)
+async def configure(default_route=None, ttl=None, delivery_grace=None):
+    global _delivery_grace
+    if delivery_grace is not None:
+        _delivery_grace = delivery_grace
+    await get_store().setup(default_route, ttl=ttl)
+
+
+def _index_pending(doc):
+    if doc.get("tg_msg_id") is not None:
+        _pending_tg[(doc.get("route"), doc["tg_msg_id"])] = doc["_id"]
+    if doc.get("dc_msg_id") is not None:
+        _pending_dc[(doc.get("route"), doc["dc_msg_id"])] = doc["_id"]
+
+
+def _buffered(internal_id):
+    return _pending.get(internal_id) or _inflight.get(internal_id)
+
+
+def _buffered_by(field, value, route=None):
+    index = _pending_tg if field == "tg_msg_id" else _pending_dc
+    internal_id = index.get((route, value))
+    if internal_id is not None:
+        return _buffered(internal_id)
+    for doc in _inflight.values():
+        if doc.get(field) == value and doc.get("route") == route:
+            return doc
+    return None
+
+
+def _route_filter(query, route):
+    if route is not None:
+        query["route"] = route
+    return query
+
+
+def _apply(filter_, update, local):
+    if "_id" in filter_:
+        doc = _buffered(filter_["_id"])
+    else:
+        field = "tg_msg_id" if "tg_msg_id" in filter_ else "dc_msg_id"
+        doc = _buffered_by(field, filter_[field], filter_.get("route"))
+    if doc is not None:
+        local(doc)
+        if doc["_id"] in _pending:
+            _index_pending(doc)
+            return
+        filter_ = {"_id": doc["_id"]}
+    # backends apply either the Mongo update document or the local mutation
+    _pending_ops.append((filter_, update, local))
+
+
+def _set_path(doc, key, value):
+    # dotted keys behave like Mongo's $set on embedded documents
+    *parents, leaf = key.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[leaf] = value
+
+
+def _set_fields(filter_, fields):
+    def local(doc):
+        for key, value in fields.items():
+            _set_path(doc, key, value)
+
+    _apply(filter_, {"$set": fields}, local)
+
+
+async def _written():
+    if _writer_task is None:
+        await flush()
+    elif len(_pending) + len(_pending_ops) >= _batch_size:
+        _wake.set()
 
 
-async def add_message(source, text, username=None, tg_msg_id=None, dc_msg_id=None, reply_to_tg_id=None, reply_to_dc_id=None, reply_to_id=None,timestamp=None):
-    db = get_db()
-    col = db["messages"]
+@timed("flush")
+async def flush():
+    global _pending, _pending_tg, _pending_dc, _pending_ops, _inflight
+    async with _flush_lock:
+        if not _pending and not _pending_ops:
+            return 0
+        docs, ops = _pending, _pending_ops
+        _pending, _pending_tg, _pending_dc, _pending_ops = {}, {}, {}, []
+        _inflight = docs
+
+        try:
+            written = await get_store().write(list(docs.values()), ops)
+        except Exception:
+            logger.exception(f"Write of {len(docs) + len(ops)} operations failed, requeueing")
+            for internal_id, doc in docs.items():
+                _pending.setdefault(internal_id, doc)
+                _index_pending(doc)
+            _pending_ops[:0] = ops
+            raise
+        finally:
+            _inflight = {}
+        return written
+
+
+async def _writer_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=_flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        try:
+            await flush()
+        except Exception:
+            await asyncio.sleep(_flush_interval)
+
+
+def start_writer(batch_size=100, flush_interval=0.5):
+    global _writer_task, _wake, _batch_size, _flush_interval
+    _batch_size = batch_size
+    _flush_interval = flush_interval
+    _wake = asyncio.Event()
+    _writer_task = asyncio.create_task(_writer_loop())
+    return _writer_task
+
+
+async def stop_writer():
+    global _writer_task
+    if _writer_task is not None:
+        _writer_task.cancel()
+        await asyncio.gather(_writer_task, return_exceptions=True)
+        _writer_task = None
+    await flush()
+
+
+def storage_stats():
+    store = get_store()
+    return {
+        "backend": store.name if store else None,
+        "pending_documents": len(_pending),
+        "pending_updates": len(_pending_ops),
+        **(store.stats() if store else {}),
+    }
+
+
+def add_listener(callback):
+    _listeners.append(callback)
+
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def _notify(doc):
+    shaped = api_shape(doc)
+    for callback in _listeners:
+        try:
+            callback(shaped)
+        except Exception:
+            logger.exception("Message listener failed")
+
+
+def _new_message(source, text, username=None, tg_msg_id=None, dc_msg_id=None, reply_to_tg_id=None, reply_to_dc_id=None, reply_to_id=None, timestamp=None, route=None, attachments=None, deliver_to=None):
     doc = {
         "_id": str(uuid.uuid4()),
+        "route": route,
         "source": source,
         "text": text,
         "username": username,
@@ -33,58 +211,298 @@ async def add_message(source, text, username=None, tg_msg_id=None, dc_msg_id=Non
         "reply_to_tg_id": reply_to_tg_id,
         "reply_to_dc_id": reply_to_dc_id,
     }
-    await col.insert_one(doc)
+    if attachments:
+        doc["attachments"] = attachments
+    if deliver_to:
+        # outbox entries live on the message so they are persisted by the same write
+        doc["delivery"] = {
+            platform: {
+                "state": "pending",
+                "attempts": 0,
+                "next_at": doc["timestamp"] + _delivery_grace,
+                "key": f"{doc['_id']}:{platform}",
+            }
+            for platform in deliver_to
+        }
+    _pending[doc["_id"]] = doc
+    _index_pending(doc)
+    _notify(doc)
     return doc["_id"]
 
 
-async def list_messages(limit=50, offset=0):
-    db = get_db()
-    col = db["messages"]
-    cursor = col.find({}, sort=[("timestamp", -1)], skip=offset)
-    items = await cursor.to_list(length=limit)
+@timed("add_message")
+async def add_message(source, text, username=None, tg_msg_id=None, dc_msg_id=None, reply_to_tg_id=None, reply_to_dc_id=None, reply_to_id=None,timestamp=None, route=None, attachments=None, deliver_to=None):
+    internal_id = _new_message(
+        source, text, username, tg_msg_id, dc_msg_id, reply_to_tg_id, reply_to_dc_id, reply_to_id,
+        timestamp, route, attachments, deliver_to,
+    )
+    if deliver_to:
+        # the outbox entry must be durable before the send is queued, or a crash loses the message unbridged
+        await flush()
+    else:
+        await _written()
+    return internal_id
+
+
+@timed("add_messages")
+async def add_messages(messages):
+    ids = [_new_message(**m) for m in messages]
+    # persisted before anything is sent: one store write for the whole batch
+    await flush()
+    return ids
+
+
+def encode_cursor(d):
+    raw = json.dumps([d["timestamp"], d["id"] if "id" in d else d["_id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        timestamp, internal_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(timestamp), str(internal_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def encode_search_cursor(d, sort="relevance"):
+    if sort != "relevance":
+        return encode_cursor(d)
+    raw = json.dumps([d["score"], d["timestamp"], d["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(token, sort="relevance"):
+    if sort != "relevance":
+        return decode_cursor(token)
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        score, timestamp, internal_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(score), float(timestamp), str(internal_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def build_projection(fields):
+    if not fields:
+        return None
+    unknown = set(fields) - MESSAGE_FIELDS
+    if unknown:
+        raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+    # timestamp and _id are always needed to build the next cursor
+    projection = {f: 1 for f in fields}
+    projection["timestamp"] = 1
+    return projection
+
+
+def _criteria(route=None, source=None, username=None, since=None, until=None):
+    return {"route": route, "source": source, "username": username, "since": since, "until": until}
+
+
+@timed("list_messages")
+async def list_messages(limit=50, offset=0, after=None, before=None, fields=None, source=None, username=None, route=None):
+    await flush()
+    projection = build_projection(fields)
+    order = -1
+    cursor = None
+    if after or before:
+        cursor = decode_cursor(after or before)
+        offset = 0
+        if before:
+            order = 1
+
+    items = await get_store().find(
+        _criteria(route, source, username),
+        order=order,
+        after=cursor,
+        limit=limit,
+        offset=offset,
+        projection=projection,
+    )
+    if order == 1:
+        items.reverse()
+    return [api_shape(d) for d in items]
+
+
+@timed("search_messages")
+async def search_messages(q, limit=50, after=None, sort="relevance", fields=None, source=None, username=None, since=None, until=None, route=None):
+    if sort not in ("relevance", "time"):
+        raise ValueError("sort must be 'relevance' or 'time'")
+    projection = build_projection(fields)
+    cursor = decode_search_cursor(after, sort) if after else None
+    await flush()
+    items = await get_store().search(
+        q,
+        _criteria(route, source, username, since, until),
+        sort=sort,
+        after=cursor,
+        limit=limit,
+        projection=projection,
+    )
     return [api_shape(d) for d in items]
 
 
+async def iter_messages(since=None, until=None, source=None, username=None, fields=None, batch_size=1000, after=None, route=None):
+    await flush()
+    projection = build_projection(fields)
+    cursor = decode_cursor(after) if after else None
+    async for d in get_store().iterate(
+        _criteria(route, source, username, since, until),
+        after=cursor,
+        projection=projection,
+        batch_size=batch_size,
+    ):
+        yield api_shape(d)
+
+
+@timed("get_message")
 async def get_message(internal_id):
-    db = get_db()
-    col = db["messages"]
-    d = await col.find_one({"_id": internal_id})
+    d = _buffered(internal_id)
+    if d is not None:
+        return api_shape(d)
+    d = await get_store().get(internal_id)
     return api_shape(d)
 
 
-async def find_by_tg_id(tg_msg_id):
-    db = get_db()
-    col = db["messages"]
-    d = await col.find_one({"tg_msg_id": tg_msg_id})
+@timed("find_by_tg_id")
+async def find_by_tg_id(tg_msg_id, route=None):
+    d = _buffered_by("tg_msg_id", tg_msg_id, route)
+    if d is not None:
+        return api_shape(d)
+    d = await get_store().find_one(_route_filter({"tg_msg_id": tg_msg_id}, route))
     return api_shape(d)
 
 
-async def find_by_dc_id(dc_msg_id):
-    db = get_db()
-    col = db["messages"]
-    d = await col.find_one({"dc_msg_id": dc_msg_id})
+@timed("find_by_dc_id")
+async def find_by_dc_id(dc_msg_id, route=None):
+    d = _buffered_by("dc_msg_id", dc_msg_id, route)
+    if d is not None:
+        return api_shape(d)
+    d = await get_store().find_one(_route_filter({"dc_msg_id": dc_msg_id}, route))
     return api_shape(d)
 
 
-async def set_dc_id_for_tg(tg_msg_id, dc_msg_id):
-    db = get_db()
-    col = db["messages"]
-    await col.update_many({"tg_msg_id": tg_msg_id}, {"$set": {"dc_msg_id": dc_msg_id}})
+@timed("thread_ancestors")
+async def thread_ancestors(internal_id=None, tg_msg_id=None, dc_msg_id=None, route=None, max_depth=50):
+    if internal_id is not None:
+        filter_ = {"_id": internal_id}
+        d = _buffered(internal_id)
+    elif tg_msg_id is not None:
+        filter_ = _route_filter({"tg_msg_id": tg_msg_id}, route)
+        d = _buffered_by("tg_msg_id", tg_msg_id, route)
+    else:
+        filter_ = _route_filter({"dc_msg_id": dc_msg_id}, route)
+        d = _buffered_by("dc_msg_id", dc_msg_id, route)
+    # the newest links may still be buffered; the rest of the chain comes from one store query
+    chain = []
+    while d is not None and len(chain) <= max_depth:
+        chain.append(d)
+        filter_ = {"_id": d["reply_to_id"]} if d.get("reply_to_id") else None
+        d = _buffered(filter_["_id"]) if filter_ else None
+    if filter_ is not None and len(chain) <= max_depth:
+        chain.extend(await get_store().ancestors(filter_, max_depth - len(chain)))
+    return [api_shape(d) for d in chain]
+
 
+@timed("get_thread")
+async def get_thread(internal_id, max_depth=50):
+    # a thread is one store query, so it has to see what is still buffered
+    await flush()
+    return [api_shape(d) for d in await get_store().thread(internal_id, max_depth)]
 
-async def set_tg_id_for_dc(dc_msg_id, tg_msg_id):
-    db = get_db()
-    col = db["messages"]
-    await col.update_many({"dc_msg_id": dc_msg_id}, {"$set": {"tg_msg_id": tg_msg_id}})
+
+@timed("recent_id_pairs")
+async def recent_id_pairs(limit=50000, route=None):
+    await flush()
+    items = await get_store().id_pairs(route=route, limit=limit)
+    return [(int(d["tg_msg_id"]), int(d["dc_msg_id"])) for d in items]
+
+
+def _sent_fields(platform, dest_msg_id):
+    return {
+        PLATFORM_ID_FIELDS[platform]: dest_msg_id,
+        f"delivery.{platform}.state": "sent",
+        f"delivery.{platform}.sent_at": time.time(),
+    }
+
+
+@timed("mark_sent")
+async def mark_sent(internal_id, platform, dest_msg_id):
+    # the id back-fill and the delivery state change land in one update
+    _set_fields({"_id": internal_id}, _sent_fields(platform, dest_msg_id))
+    await _written()
+
+
+@timed("mark_sent_all")
+async def mark_sent_all(internal_id, sent):
+    # several destinations' back-fills and delivery states in one update
+    fields = {}
+    for platform, dest_msg_id in sent.items():
+        fields.update(_sent_fields(platform, dest_msg_id))
+    _set_fields({"_id": internal_id}, fields)
+    await _written()
+
+
+@timed("mark_attempt")
+async def mark_attempt(internal_id, platform, attempts, next_at, failed=False):
+    _set_fields({"_id": internal_id}, {
+        f"delivery.{platform}.state": "failed" if failed else "pending",
+        f"delivery.{platform}.attempts": attempts,
+        f"delivery.{platform}.next_at": next_at,
+    })
+    await _written()
+
+
+@timed("extend_lease")
+async def extend_lease(internal_id, platform, until):
+    # a pending entry is only due once next_at passes, so pushing it out keeps recovery away
+    _set_fields({"_id": internal_id}, {f"delivery.{platform}.next_at": until})
+    await _written()
+
+
+@timed("due_deliveries")
+async def due_deliveries(now=None, limit=100):
+    await flush()
+    return [api_shape(d) for d in await get_store().due(float(now or time.time()), limit)]
+
+
+def _platform_filter(tg_msg_id=None, dc_msg_id=None, route=None):
+    if tg_msg_id is not None:
+        return _route_filter({"tg_msg_id": tg_msg_id}, route)
+    return _route_filter({"dc_msg_id": dc_msg_id}, route)
+
+
+@timed("record_edit")
+async def record_edit(text, tg_msg_id=None, dc_msg_id=None, route=None, edited_at=None):
+    edited_at = float(edited_at or time.time())
+
+    def local(doc):
+        doc.setdefault("history", []).append({"text": doc.get("text"), "edited_at": doc.get("edited_at", doc.get("timestamp"))})
+        doc["text"] = text
+        doc["edited_at"] = edited_at
+
+    # pipeline update so the previous text moves into history without a read round trip
+    update = [{"$set": {
+        "history": {"$concatArrays": [
+            {"$ifNull": ["$history", []]},
+            [{"text": "$text", "edited_at": {"$ifNull": ["$edited_at", "$timestamp"]}}],
+        ]},
+        "text": text,
+        "edited_at": edited_at,
+    }}]
+    _apply(_platform_filter(tg_msg_id, dc_msg_id, route), update, local)
+    await _written()
 
 
-async def set_tg_msg_id(internal_id, tg_msg_id):
-    db = get_db()
-    col = db["messages"]
-    await col.update_one({"_id": internal_id}, {"$set": {"tg_msg_id": tg_msg_id}})
+@timed("set_attachments")
+async def set_attachments(internal_id, attachments):
+    _set_fields({"_id": internal_id}, {"attachments": attachments})
+    await _written()
 
 
-async def set_dc_msg_id(internal_id, dc_msg_id):
-    db = get_db()
-    col = db["messages"]
-    await col.update_one({"_id": internal_id}, {"$set": {"dc_msg_id": dc_msg_id}})
+@timed("mark_deleted")
+async def mark_deleted(tg_msg_id=None, dc_msg_id=None, route=None, deleted_at=None):
+    fields = {"deleted": True, "deleted_at": float(deleted_at or time.time())}
+    _set_fields(_platform_filter(tg_msg_id, dc_msg_id, route), fields)
+    await _written()
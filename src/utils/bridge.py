@@ -1,13 +1,18 @@
+from collections import OrderedDict
+import discord
+from telegram.error import BadRequest
+from src.core.echo import echoes
+
 TG_TAG = "[TG]"
 DC_TAG = "[DC]"
+API_TAG = "[API]"
 
+# Discord error codes for a reply target that no longer exists
+UNKNOWN_MESSAGE = 10008
+INVALID_FORM_BODY = 50035
 
-def istg(text):
-    return text.startswith(TG_TAG)
-
-
-def isdd(text):
-    return text.startswith(DC_TAG)
+_dc_messages = OrderedDict()
+dc_message_cache_size = 1000
 
 
 def tgformat(username, text):
@@ -18,32 +23,81 @@ def ddformat(display_name, text):
     return f"{DC_TAG} {display_name}: {text}"
 
 
+def apiformat(username, text):
+    return f"{API_TAG} {username}: {text}"
+
+
 async def fwd_to_dd(dbot, channel_id, message):
     channel = dbot.get_channel(channel_id)
     if not channel:
         print(f"Discord channel not found: {channel_id}")
         return
-    await channel.send(message)
+    sent = await channel.send(message)
+    echoes.add("discord", channel_id, sent.id)
 
 
 async def fwd_tg(tbot, chat_id, message):
-    await tbot.bot.send_message(chat_id=chat_id, text=message)
+    sent = await tbot.bot.send_message(chat_id=chat_id, text=message)
+    echoes.add("telegram", chat_id, sent.message_id)
+
+
+def get_dc_channel(dbot, channel_id):
+    # REST-only clients (shard workers) have no gateway cache to look channels up in
+    return dbot.get_channel(channel_id) or dbot.get_partial_messageable(channel_id)
+
+
+def remember_dc_message(message):
+    _dc_messages[message.id] = message
+    _dc_messages.move_to_end(message.id)
+    while len(_dc_messages) > dc_message_cache_size:
+        _dc_messages.popitem(last=False)
+
+
+def forget_dc_message(message_id):
+    _dc_messages.pop(message_id, None)
+
+
+def dc_reference(channel, message_id):
+    cached = _dc_messages.get(message_id)
+    if cached is not None:
+        _dc_messages.move_to_end(message_id)
+        return cached.to_reference(fail_if_not_exists=False)
+    return discord.MessageReference(
+        message_id=message_id,
+        channel_id=channel.id,
+        guild_id=getattr(getattr(channel, "guild", None), "id", None),
+        fail_if_not_exists=False,
+    )
+
+
+async def send_dd(channel, message, message_id=None, files=None):
+    kwargs = {"files": files} if files else {}
+    if message_id:
+        try:
+            sent = await channel.send(message, reference=dc_reference(channel, message_id), **kwargs)
+        except discord.HTTPException as e:
+            if e.code not in (UNKNOWN_MESSAGE, INVALID_FORM_BODY):
+                raise
+            # the replied-to message was deleted; post without threading
+            forget_dc_message(message_id)
+            for f in files or []:
+                f.reset()
+            sent = await channel.send(message, **kwargs)
+    else:
+        sent = await channel.send(message, **kwargs)
+    if sent is not None:
+        remember_dc_message(sent)
+        echoes.add("discord", channel.id, sent.id)
+    return sent
 
 
 async def fwd_dd_with_reply(dbot, channel_id, message, message_id=None):
-    channel = dbot.get_channel(channel_id)
+    channel = get_dc_channel(dbot, channel_id)
     if not channel:
         print(f"Discord channel not found: {channel_id}")
         return None
 
-    if message_id:
-        try:
-            ref_msg = await channel.fetch_message(message_id)
-            sent = await ref_msg.reply(message)
-        except:
-            sent = await channel.send(message)
-    else:
-        sent = await channel.send(message)
+    sent = await send_dd(channel, message, message_id=message_id)
     return getattr(sent, "id", None)
 
 
@@ -53,4 +107,34 @@ async def fwd_to_tg_rply(tbot, chat_id, message, msg_id=None):
         text=message,
         reply_to_message_id=msg_id,
     )
+    echoes.add("telegram", chat_id, getattr(sent, "message_id", None))
     return getattr(sent, "message_id", None)
+
+
+async def edit_dd(dbot, channel_id, message_id, message):
+    channel = get_dc_channel(dbot, channel_id)
+    try:
+        await channel.get_partial_message(message_id).edit(content=message)
+    except discord.NotFound:
+        forget_dc_message(message_id)
+
+
+async def edit_tg(tbot, chat_id, message_id, message):
+    try:
+        await tbot.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=message)
+    except BadRequest as e:
+        error = str(e).lower()
+        if "not modified" in error:
+            return
+        if "no text" not in error:
+            raise
+        # media copies carry the text as a caption
+        await tbot.bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=message)
+
+
+async def delete_tg(tbot, chat_id, message_id):
+    try:
+        await tbot.bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except BadRequest as e:
+        if "not found" not in str(e).lower():
+            raise
@@ -0,0 +1,311 @@
+import hashlib
+import tempfile
+import time
+from collections import OrderedDict
+import discord
+import httpx
+from telegram import InputFile
+from telegram.error import BadRequest
+from src.core.echo import echoes
+from src.utils.bridge import get_dc_channel, send_dd
+
+CHUNK_SIZE = 64 * 1024
+# files up to this size stay in memory while in transit, larger ones spill to disk
+SPOOL_SIZE = 1024 * 1024
+TG_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+TG_URL_UPLOAD_LIMIT = 20 * 1024 * 1024
+# Telegram only fetches photos up to this size by URL, and documents only of these types
+TG_URL_PHOTO_LIMIT = 5 * 1024 * 1024
+TG_URL_DOCUMENT_TYPES = (".gif", ".pdf", ".zip")
+DC_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class MediaCache:
+    def __init__(self, max_size=2000, ttl=12 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._refs = OrderedDict()
+        self._aliases = OrderedDict()
+
+    def _trim(self, data):
+        while len(data) > self.max_size:
+            data.popitem(last=False)
+
+    def alias(self, source_key, sha256=None):
+        if sha256 is not None:
+            self._aliases[source_key] = sha256
+            self._aliases.move_to_end(source_key)
+            self._trim(self._aliases)
+            return sha256
+        return self._aliases.get(source_key)
+
+    def get(self, sha256, destination):
+        entry = self._refs.get((sha256, destination))
+        if entry is None:
+            return None
+        ref, expires = entry
+        if expires <= time.monotonic():
+            del self._refs[(sha256, destination)]
+            return None
+        return ref
+
+    def put(self, sha256, destination, ref, ttl=None):
+        if not sha256 or not ref:
+            return
+        self._refs[(sha256, destination)] = (ref, time.monotonic() + (ttl or self.ttl))
+        self._refs.move_to_end((sha256, destination))
+        self._trim(self._refs)
+
+
+cache = MediaCache()
+_http = None
+
+
+def configure(discord_limit=None, telegram_limit=None, cache_size=None):
+    global DC_UPLOAD_LIMIT, TG_URL_UPLOAD_LIMIT
+    if discord_limit:
+        DC_UPLOAD_LIMIT = discord_limit
+    if telegram_limit:
+        TG_URL_UPLOAD_LIMIT = telegram_limit
+    if cache_size:
+        cache.max_size = cache_size
+
+
+def http_client():
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0), follow_redirects=True)
+    return _http
+
+
+async def close():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+async def stream_download(url, max_bytes):
+    digest = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    size = 0
+    try:
+        async with http_client().stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MediaTooLarge(f"{size} bytes exceeds the {max_bytes} byte limit")
+                digest.update(chunk)
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+
+def tg_attachments(message):
+    found = []
+    if message.photo:
+        found.append(("photo", message.photo[-1], "photo.jpg"))
+    for kind in ("document", "video", "animation", "audio", "voice", "video_note", "sticker"):
+        media = getattr(message, kind, None)
+        if media:
+            found.append((kind, media, getattr(media, "file_name", None) or default_name(kind, media)))
+    return [
+        {
+            "kind": kind,
+            "file_id": media.file_id,
+            "file_unique_id": media.file_unique_id,
+            "name": name,
+            "mime_type": getattr(media, "mime_type", None),
+            "size": getattr(media, "file_size", None),
+        }
+        for kind, media, name in found
+    ]
+
+
+def default_name(kind, media):
+    if kind == "sticker":
+        if getattr(media, "is_animated", False):
+            return "sticker.tgs"
+        return "sticker.webm" if getattr(media, "is_video", False) else "sticker.webp"
+    return {"voice": "voice.ogg", "video_note": "video_note.mp4", "video": "video.mp4", "animation": "animation.mp4", "audio": "audio.mp3"}.get(kind, "file")
+
+
+def dc_attachments(message):
+    found = [
+        {
+            "kind": "file",
+            "id": a.id,
+            "name": a.filename,
+            "url": a.url,
+            "mime_type": a.content_type,
+            "size": a.size,
+        }
+        for a in message.attachments
+    ]
+    for sticker in getattr(message, "stickers", []):
+        found.append({"kind": "sticker", "id": sticker.id, "name": f"{sticker.name}.png", "url": sticker.url, "mime_type": "image/png", "size": None})
+    return found
+
+
+def storable(attachments):
+    # keeps the platform references so the outbox can replay the upload after a restart
+    keys = ("kind", "name", "mime_type", "size", "file_id", "file_unique_id", "id", "url", "sha256", "refs")
+    return [{k: a[k] for k in keys if a.get(k) is not None} for a in attachments]
+
+
+async def send_media_to_discord(tbot, dbot, channel_id, text, attachments, reply_to=None, limit=None):
+    limit = limit or DC_UPLOAD_LIMIT
+    channel = get_dc_channel(dbot, channel_id)
+    files = []
+    uploaded = []
+    lines = [text]
+    try:
+        for a in attachments:
+            if a.get("size") and a["size"] > min(limit, TG_DOWNLOAD_LIMIT):
+                lines.append(f"({a['name']} is too large to bridge)")
+                continue
+            sha256 = a.get("sha256") or cache.alias(("tg", a["file_unique_id"]))
+            url = cache.get(sha256, "discord") if sha256 else None
+            if url:
+                lines.append(url)
+                continue
+            tg_file = await tbot.bot.get_file(a["file_id"])
+            try:
+                spool, sha256, size = await stream_download(tg_file.file_path, min(limit, TG_DOWNLOAD_LIMIT))
+            except MediaTooLarge:
+                lines.append(f"({a['name']} is too large to bridge)")
+                continue
+            a["sha256"], a["size"] = sha256, size
+            cache.alias(("tg", a["file_unique_id"]), sha256)
+            url = cache.get(sha256, "discord")
+            if url:
+                spool.close()
+                lines.append(url)
+                continue
+            files.append(discord.File(spool, filename=a["name"]))
+            uploaded.append(a)
+
+        sent = await send_dd(channel, "\n".join(lines), message_id=reply_to, files=files)
+    finally:
+        for f in files:
+            f.close()
+    for a, attachment in zip(uploaded, getattr(sent, "attachments", [])):
+        cache.put(a["sha256"], "discord", attachment.url)
+        a.setdefault("refs", {})["discord"] = attachment.url
+    return getattr(sent, "id", None)
+
+
+def tg_file_id(sent):
+    media = sent.effective_attachment
+    if isinstance(media, (list, tuple)):
+        media = media[-1] if media else None
+    return getattr(media, "file_id", None)
+
+
+def dc_cache_key(a):
+    # Telegram fetches Discord files by URL, so the bytes are never hashed; the attachment id stands in
+    return f"dc:{a['id']}"
+
+
+async def upload_to_telegram(tbot, chat_id, a, limit, **kwargs):
+    spool, sha256, size = await stream_download(a["url"], limit)
+    with spool:
+        a["sha256"], a["size"] = sha256, size
+        # the same file posted again under a new attachment id goes out by file id
+        ref = cache.get(sha256, "telegram:document")
+        # read_file_handle=False hands the spool to the HTTP client as a stream instead of reading it into memory
+        document = ref or InputFile(spool, filename=a["name"], read_file_handle=False)
+        return await tbot.bot.send_document(chat_id=chat_id, document=document, **kwargs)
+
+
+async def send_document_to_telegram(tbot, chat_id, a, limit, key, **kwargs):
+    source = cache.get(key, "telegram:document")
+    if source is None and a["name"].lower().endswith(TG_URL_DOCUMENT_TYPES):
+        source = a["url"]
+    if source:
+        try:
+            return await tbot.bot.send_document(chat_id=chat_id, document=source, filename=a["name"], **kwargs)
+        except BadRequest:
+            # a file id Telegram no longer knows, or a URL it would not fetch
+            pass
+    return await upload_to_telegram(tbot, chat_id, a, limit, **kwargs)
+
+
+async def send_media_to_telegram(tbot, chat_id, text, attachments, reply_to=None, limit=None):
+    limit = limit or TG_URL_UPLOAD_LIMIT
+    first_id = None
+    caption = text
+    notes = []
+    for a in attachments:
+        if a.get("size") and a["size"] > limit:
+            notes.append(f"({a['name']} is too large to bridge)")
+            continue
+        key = dc_cache_key(a)
+        is_photo = (
+            (a.get("mime_type") or "").startswith("image/")
+            and not a["name"].lower().endswith(".gif")
+            and a.get("size") is not None
+            and a["size"] <= TG_URL_PHOTO_LIMIT
+        )
+        kwargs = {"caption": caption, "reply_to_message_id": reply_to}
+        sent = None
+        if is_photo:
+            destination = "telegram:photo"
+            try:
+                sent = await tbot.bot.send_photo(chat_id=chat_id, photo=cache.get(key, destination) or a["url"], **kwargs)
+            except BadRequest:
+                # rejected as a photo (dimensions, format); it still goes through as a document
+                sent = None
+        if sent is None:
+            destination = "telegram:document"
+            try:
+                sent = await send_document_to_telegram(tbot, chat_id, a, limit, key, **kwargs)
+            except MediaTooLarge:
+                notes.append(f"({a['name']} is too large to bridge)")
+                continue
+            except BadRequest:
+                # one bad file must not hold back the text and the other attachments
+                notes.append(f"({a['name']} could not be bridged)")
+                continue
+        ref = tg_file_id(sent)
+        cache.put(key, destination, ref)
+        cache.put(a.get("sha256"), destination, ref)
+        if ref:
+            a.setdefault("refs", {})[destination] = ref
+        echoes.add("telegram", chat_id, sent.message_id)
+        first_id = first_id or sent.message_id
+        caption = None
+        reply_to = None
+
+    if caption is not None or notes:
+        sent = await tbot.bot.send_message(
+            chat_id=chat_id,
+            text="\n".join(([caption] if caption is not None else []) + notes),
+            reply_to_message_id=reply_to,
+        )
+        echoes.add("telegram", chat_id, sent.message_id)
+        first_id = first_id or sent.message_id
+    return first_id
+
+
+def warm(docs):
+    # refs persisted on recent messages survive a restart; Discord URLs are signed, so they keep their original expiry
+    now = time.time()
+    for doc in docs:
+        age = now - doc["timestamp"]
+        if age >= cache.ttl:
+            continue
+        for a in doc.get("attachments") or []:
+            if a.get("sha256") and a.get("file_unique_id"):
+                cache.alias(("tg", a["file_unique_id"]), a["sha256"])
+            key = a.get("sha256") or (dc_cache_key(a) if a.get("id") else None)
+            for destination, ref in (a.get("refs") or {}).items():
+                cache.put(key, destination, ref, ttl=cache.ttl - age)
@@ -0,0 +1,22 @@
+import asyncio
+import pytest
+from src.database import database, store_functions
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def run(request, tmp_path):
+    cfg = {"storage_backend": request.param, "sqlite_path": str(tmp_path / "bindsync.db")}
+
+    def runner(test, grace=120.0):
+        async def main():
+            await database.init_store(cfg)
+            await store_functions.configure(default_route="main", delivery_grace=grace)
+            try:
+                await test()
+            finally:
+                await store_functions.stop_writer()
+                await database.close_store()
+
+        asyncio.run(main())
+
+    return runner
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from src.bot.tg_bot import TelegramBot
+from src.core.idmap import MessageIdMap
+from src.core.outbox import Outbox
+from src.core.routes import Route, RouteTable
+from src.database import store_functions
+
+
+def make_bot(sends, dest_msg_id=500, burst_window=0, gate=None):
+    route = Route("main", 1, 2, MessageIdMap(route="main"), burst_window=burst_window)
+    bot = TelegramBot(routes=RouteTable([route]), token="x")
+    bot.set_outbox(Outbox(base_delay=10.0))
+
+    # stands in for the dispatcher: on_sent runs before the future resolves
+    async def forward(route, message, reply_to_discord_message_id=None, on_sent=None, attachments=None):
+        sends.append(message)
+        future = asyncio.get_running_loop().create_future()
+
+        async def send():
+            if gate:
+                await gate.wait()
+            try:
+                await on_sent(dest_msg_id)
+            finally:
+                future.set_result(dest_msg_id)
+
+        asyncio.ensure_future(send())
+        return future
+
+    bot.set_forward_callback(forward)
+    return bot, route
+
+
+def event(tg_msg_id, text="hi", attachments=()):
+    return {
+        "route": "main",
+        "text": text,
+        "attachments": list(attachments),
+        "username": "u",
+        "tg_msg_id": tg_msg_id,
+        "reply_to_tg_id": None,
+        "received": time.time(),
+    }
+
+
+async def replays_after_restart():
+    replayed = []
+
+    async def replay(doc, platform):
+        replayed.append((doc["text"], platform))
+
+    outbox = Outbox()
+    outbox.set_replay(replay)
+    await outbox.recover()
+    return replayed
+
+
+def test_text_message_is_backfilled_and_not_replayed(run):
+    async def test():
+        sends = []
+        bot, route = make_bot(sends)
+        await bot.process(route, event(10))
+        await bot.outbox.close()
+
+        doc = await store_functions.find_by_tg_id(10, route="main")
+        assert doc["dc_msg_id"] == 500
+        assert doc["delivery"]["discord"]["state"] == "sent"
+        assert route.id_map.tg_to_dc.get(10) == 500
+        assert await replays_after_restart() == []
+        assert sends == ["[TG] u: hi"]
+
+    run(test, grace=0)
+
+
+def test_media_send_without_id_is_retried(run):
+    async def test():
+        bot, route = make_bot([], dest_msg_id=None)
+        photo = {"kind": "photo", "name": "a.jpg", "file_id": "f", "file_unique_id": "u"}
+        await bot.process(route, event(11, attachments=[photo]))
+        await bot.outbox.close()
+
+        doc = await store_functions.find_by_tg_id(11, route="main")
+        assert doc["dc_msg_id"] is None
+        assert doc["delivery"]["discord"]["state"] == "pending"
+        assert doc["delivery"]["discord"]["attempts"] == 1
+        assert doc["attachments"] == [photo]
+
+    run(test, grace=0)
+
+
+def test_coalesced_burst_is_in_flight_for_every_message(run):
+    async def test():
+        sends, gate = [], asyncio.Event()
+        bot, route = make_bot(sends, burst_window=0.01, gate=gate)
+        for tg_msg_id in (20, 21, 22):
+            await bot.process(route, event(tg_msg_id, text=f"line {tg_msg_id}"))
+        await asyncio.sleep(0.05)
+        assert sends == ["[TG] u: line 20\nline 21\nline 22"]
+        assert bot.outbox.stats()["inflight"] == 3
+
+        # the merged send is still queued past the grace period: recovery must leave every line alone
+        replayed = []
+
+        async def replay(doc, platform):
+            replayed.append(doc["text"])
+
+        bot.outbox.set_replay(replay)
+        assert await bot.outbox.recover() == 0
+
+        gate.set()
+        await bot.outbox.close()
+        for tg_msg_id in (20, 21, 22):
+            doc = await store_functions.find_by_tg_id(tg_msg_id, route="main")
+            assert doc["delivery"]["discord"]["state"] == "sent"
+            assert doc["dc_msg_id"] == 500
+        assert replayed == []
+
+    run(test, grace=0)
@@ -0,0 +1,44 @@
+import asyncio
+from src.core import fanout
+
+
+def test_fan_out_reports_each_destination():
+    async def test():
+        loop = asyncio.get_running_loop()
+        sent, failed, slow = loop.create_future(), loop.create_future(), loop.create_future()
+        sent.set_result(5)
+        failed.set_exception(RuntimeError("down"))
+        results = await fanout.fan_out({"telegram": sent, "discord": failed, "other": slow, "skipped": None}, 0.05)
+        assert {p: r["status"] for p, r in results.items()} == {"telegram": "sent", "discord": "failed", "other": "timeout"}
+        assert fanout.sent_ids(results) == {"telegram": 5}
+        # the timeout only stopped the wait
+        assert not slow.cancelled()
+
+    asyncio.run(test())
+
+
+def test_backfill_merges_what_lands_in_time_and_writes_stragglers_alone():
+    async def test():
+        writes = []
+
+        async def write(ids):
+            writes.append(ids)
+
+        backfill = fanout.Backfill(write)
+        await backfill.sent("telegram", 1)
+        await backfill.sent("discord", 2)
+        assert writes == []
+        await backfill.flush()
+        assert writes == [{"telegram": 1, "discord": 2}]
+
+        late = fanout.Backfill(write)
+        await late.sent("telegram", 3)
+        await late.flush()
+        await late.sent("discord", 4)
+        assert writes[1:] == [{"telegram": 3}, {"discord": 4}]
+
+        empty = fanout.Backfill(write)
+        await empty.flush()
+        assert len(writes) == 3
+
+    asyncio.run(test())
@@ -0,0 +1,97 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+import httpx
+import pytest
+from telegram import InputFile
+from telegram.error import BadRequest
+from src.utils import media
+
+
+class FakeBot:
+    def __init__(self, reject_uploads=False):
+        self.reject_uploads = reject_uploads
+        self.sent = []
+        self.ids = itertools.count(1)
+
+    def reply(self, kind):
+        n = next(self.ids)
+        return SimpleNamespace(message_id=n, effective_attachment=SimpleNamespace(file_id=f"{kind}{n}"))
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_to_message_id=None):
+        self.sent.append(("photo", photo, caption))
+        return self.reply("photo")
+
+    async def send_document(self, chat_id, document, filename=None, caption=None, reply_to_message_id=None):
+        if isinstance(document, InputFile):
+            if self.reject_uploads:
+                raise BadRequest("file is broken")
+            # still a handle: the upload streams it
+            assert not isinstance(document.input_file_content, bytes)
+            self.sent.append(("upload", document.input_file_content.read(), caption))
+        elif document.startswith("http") and not document.endswith(media.TG_URL_DOCUMENT_TYPES):
+            raise BadRequest("wrong type of the web page content")
+        else:
+            self.sent.append(("document", document, caption))
+        return self.reply("doc")
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None):
+        self.sent.append(("text", text, None))
+        return self.reply("text")
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    fetched = []
+
+    def handler(request):
+        fetched.append(str(request.url))
+        return httpx.Response(200, content=b"video bytes")
+
+    monkeypatch.setattr(media, "cache", media.MediaCache())
+    monkeypatch.setattr(media, "_http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return fetched
+
+
+def attachment(id, name, mime_type="video/mp4", size=11):
+    return {"kind": "file", "id": id, "name": name, "mime_type": mime_type, "size": size, "url": f"https://cdn.test/{id}/{name}"}
+
+
+def send(bot, text, attachments):
+    return asyncio.run(media.send_media_to_telegram(SimpleNamespace(bot=bot), 1, text, attachments))
+
+
+def test_video_is_streamed_up_and_reposts_reuse_the_file_id(downloads):
+    bot = FakeBot()
+    first = attachment(1, "clip.mp4")
+    send(bot, "look", [first])
+    assert bot.sent == [("upload", b"video bytes", "look")]
+    assert first["sha256"] and first["refs"] == {"telegram:document": "doc1"}
+
+    # same bytes under a new Discord attachment id: downloaded to hash, not uploaded again
+    send(bot, "again", [attachment(2, "clip.mp4")])
+    assert bot.sent[-1] == ("document", "doc1", "again")
+    assert len(downloads) == 2
+
+    # same attachment id: straight from the cache
+    send(bot, "third", [attachment(1, "clip.mp4")])
+    assert bot.sent[-1] == ("document", "doc1", "third")
+    assert len(downloads) == 2
+
+
+def test_url_only_for_small_photos_and_url_document_types(downloads):
+    bot = FakeBot()
+    send(bot, None, [
+        attachment(1, "cat.jpg", "image/jpeg", 1000),
+        attachment(2, "paper.pdf", "application/pdf", 1000),
+        attachment(3, "big.jpg", "image/jpeg", 6 * 1024 * 1024),
+    ])
+    assert [(kind, caption) for kind, _, caption in bot.sent] == [("photo", None), ("document", None), ("upload", None)]
+    assert downloads == ["https://cdn.test/3/big.jpg"]
+
+
+def test_rejected_upload_keeps_the_text(downloads):
+    bot = FakeBot(reject_uploads=True)
+    first_id = send(bot, "hello", [attachment(1, "notes.txt", "text/plain")])
+    assert bot.sent == [("text", "hello\n(notes.txt could not be bridged)", None)]
+    assert first_id == 1
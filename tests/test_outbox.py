@@ -0,0 +1,111 @@
+import asyncio
+import time
+from src.core.outbox import Outbox
+from src.database import store_functions
+
+
+def test_backoff_doubles_with_jitter_and_caps():
+    outbox = Outbox(base_delay=5.0, max_delay=60.0)
+    for attempts, expected in ((1, 5.0), (2, 10.0), (3, 20.0), (4, 40.0), (5, 60.0), (30, 60.0)):
+        for _ in range(20):
+            assert expected * 0.8 <= outbox.backoff(attempts) <= expected * 1.2
+
+
+def test_retry_later_schedules_then_gives_up(run):
+    async def test():
+        outbox = Outbox(max_attempts=3, base_delay=10.0)
+        internal_id = await store_functions.add_message("api", "x", route="main", deliver_to=["telegram"])
+
+        before = time.time()
+        await outbox.retry_later(internal_id, "telegram", 1)
+        entry = (await store_functions.get_message(internal_id))["delivery"]["telegram"]
+        assert entry["state"] == "pending"
+        assert entry["attempts"] == 1
+        assert before + 8.0 <= entry["next_at"] <= time.time() + 12.0
+        assert await store_functions.due_deliveries(now=before) == []
+        assert len(await store_functions.due_deliveries(now=entry["next_at"])) == 1
+
+        await outbox.retry_later(internal_id, "telegram", 3)
+        entry = (await store_functions.get_message(internal_id))["delivery"]["telegram"]
+        assert entry["state"] == "failed"
+        assert await store_functions.due_deliveries(now=entry["next_at"] + 1) == []
+        assert outbox.stats()["retried"] == 1
+        assert outbox.stats()["failed"] == 1
+
+    run(test)
+
+
+def test_failed_send_backs_off(run):
+    async def test():
+        outbox = Outbox(base_delay=10.0)
+        internal_id = await store_functions.add_message("api", "x", route="main", deliver_to=["discord"])
+        future = asyncio.get_running_loop().create_future()
+        outbox.track(internal_id, "discord", future)
+        assert outbox.busy(f"{internal_id}:discord")
+
+        future.set_exception(RuntimeError("discord is down"))
+        await outbox.close()
+        assert not outbox.busy(f"{internal_id}:discord")
+        entry = (await store_functions.get_message(internal_id))["delivery"]["discord"]
+        assert entry["state"] == "pending"
+        assert entry["attempts"] == 1
+        assert entry["next_at"] > time.time() + 5.0
+
+    run(test)
+
+
+def test_recover_replays_due_entries_once(run):
+    async def test():
+        outbox = Outbox(base_delay=10.0)
+        replayed = []
+
+        async def replay(doc, platform):
+            replayed.append((doc["id"], platform))
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+            return future
+
+        outbox.set_replay(replay)
+        internal_id = await store_functions.add_message("api", "x", route="main", deliver_to=["telegram"])
+        sent_id = await store_functions.add_message("api", "y", route="main", deliver_to=["telegram"])
+        await outbox.sent(sent_id, "telegram", 5)
+        assert await outbox.recover() == 0
+
+        await store_functions.mark_attempt(internal_id, "telegram", 0, 0.0)
+        assert await outbox.recover() == 1
+        await outbox.close()
+        assert replayed == [(internal_id, "telegram")]
+        # the replay came back empty, so the entry waits out a fresh backoff
+        assert await outbox.recover() == 0
+        entry = (await store_functions.get_message(internal_id))["delivery"]["telegram"]
+        assert entry["attempts"] == 1
+
+    run(test)
+
+
+def test_lease_keeps_slow_sends_out_of_recovery(run):
+    async def test():
+        sender = Outbox(timeouts=0.1, lease=0.2)
+        recovery = Outbox(lease=0.2)
+        replayed = []
+
+        async def replay(doc, platform):
+            replayed.append(platform)
+
+        recovery.set_replay(replay)
+        internal_id = await store_functions.add_message("api", "x", route="main", deliver_to=["discord"])
+        future = asyncio.get_running_loop().create_future()
+        sender.track(internal_id, "discord", future)
+        for _ in range(8):
+            await asyncio.sleep(0.1)
+            await recovery.recover()
+        await sender.sent(internal_id, "discord", 42)
+        future.set_result(42)
+        await sender.close()
+
+        assert replayed == []
+        assert sender.stats()["timeouts"] == 1
+        entry = (await store_functions.get_message(internal_id))["delivery"]["discord"]
+        assert entry["state"] == "sent"
+
+    run(test, grace=0.2)
@@ -0,0 +1,115 @@
+from src.database import store_functions
+
+
+async def add(n, start=1000.0, **kwargs):
+    return [
+        await store_functions.add_message("api", f"m{i}", username="u", route="main", timestamp=start + i // 2, **kwargs)
+        for i in range(n)
+    ]
+
+
+def test_cursor_pagination_walks_every_message_once(run):
+    async def test():
+        ids = await add(7)
+        newest_first = [d["id"] for d in await store_functions.list_messages(limit=10)]
+        assert sorted(newest_first) == sorted(ids)
+
+        pages, after = [], None
+        while True:
+            page = await store_functions.list_messages(limit=3, after=after)
+            if not page:
+                break
+            pages.append(page)
+            after = store_functions.encode_cursor(page[-1])
+        assert [d["id"] for page in pages for d in page] == newest_first
+        assert [len(p) for p in pages] == [3, 3, 1]
+
+        back = await store_functions.list_messages(limit=3, before=store_functions.encode_cursor(pages[1][0]))
+        assert [d["id"] for d in back] == [d["id"] for d in pages[0]]
+
+    run(test)
+
+
+def test_cursor_rejects_garbage(run):
+    async def test():
+        try:
+            await store_functions.list_messages(after="not-a-cursor")
+        except ValueError:
+            return
+        raise AssertionError("bad cursor accepted")
+
+    run(test)
+
+
+def test_record_edit_on_buffered_doc(run):
+    async def test():
+        store_functions.start_writer(batch_size=1000, flush_interval=60)
+        internal_id = await store_functions.add_message("telegram", "first", route="main", tg_msg_id=7, timestamp=1000.0)
+        assert store_functions._buffered(internal_id) is not None
+
+        await store_functions.record_edit("second", tg_msg_id=7, route="main", edited_at=1001.0)
+        await store_functions.record_edit("third", tg_msg_id=7, route="main", edited_at=1002.0)
+        # applied to the buffered document, not queued as store ops
+        assert store_functions._pending_ops == []
+
+        await store_functions.flush()
+        doc = await store_functions.get_message(internal_id)
+        assert doc["text"] == "third"
+        assert doc["edited_at"] == 1002.0
+        assert doc["history"] == [
+            {"text": "first", "edited_at": 1000.0},
+            {"text": "second", "edited_at": 1001.0},
+        ]
+
+    run(test)
+
+
+def test_record_edit_on_stored_doc(run):
+    async def test():
+        internal_id = await store_functions.add_message("discord", "first", route="main", dc_msg_id=9, timestamp=1000.0)
+        await store_functions.flush()
+        await store_functions.record_edit("second", dc_msg_id=9, route="main", edited_at=1001.0)
+        # another route's message with the same id is left alone
+        await store_functions.record_edit("other", dc_msg_id=9, route="elsewhere", edited_at=1002.0)
+        await store_functions.flush()
+        doc = await store_functions.get_message(internal_id)
+        assert doc["text"] == "second"
+        assert doc["history"] == [{"text": "first", "edited_at": 1000.0}]
+
+    run(test)
+
+
+def test_due_waits_for_grace_and_skips_settled_entries(run):
+    async def test():
+        pending, sent, failed = await add(3, deliver_to=["telegram", "discord"])
+        await store_functions.add_message("api", "no outbox", route="main", timestamp=1000.0)
+        assert await store_functions.due_deliveries(now=1000.0) == []
+
+        await store_functions.mark_sent(sent, "telegram", 1)
+        await store_functions.mark_sent(sent, "discord", 2)
+        await store_functions.mark_attempt(failed, "telegram", 8, 0.0, failed=True)
+        await store_functions.mark_attempt(failed, "discord", 8, 0.0, failed=True)
+        due = await store_functions.due_deliveries(now=1000.0 + 121)
+        assert [d["id"] for d in due] == [pending]
+        assert set(due[0]["delivery"]) == {"telegram", "discord"}
+
+        await store_functions.extend_lease(pending, "telegram", 5000.0)
+        assert [d["id"] for d in await store_functions.due_deliveries(now=1000.0 + 121)] == [pending]
+        await store_functions.extend_lease(pending, "discord", 5000.0)
+        assert await store_functions.due_deliveries(now=1000.0 + 121) == []
+
+    run(test)
+
+
+def test_outbox_entry_is_written_before_add_message_returns(run):
+    async def test():
+        store_functions.start_writer(batch_size=1000, flush_interval=60)
+        internal_id = await store_functions.add_message("telegram", "x", route="main", tg_msg_id=3, deliver_to=["discord"])
+        stored = await store_functions.get_store().find_one({"_id": internal_id})
+        assert stored["delivery"]["discord"]["state"] == "pending"
+
+        # messages with nothing to deliver stay in the write-behind buffer
+        buffered = await store_functions.add_message("api", "y", route="main")
+        assert await store_functions.get_store().find_one({"_id": buffered}) is None
+
+    run(test)
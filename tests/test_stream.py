@@ -0,0 +1,25 @@
+import asyncio
+from src.api.server import app
+from src.core.hub import hub
+
+
+def test_websocket_disconnect_releases_the_subscription():
+    async def test():
+        incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+        scope = {"type": "websocket", "path": "/messages/stream", "query_string": b"", "headers": [], "subprotocols": []}
+        await incoming.put({"type": "websocket.connect"})
+        handler = asyncio.create_task(app(scope, incoming.get, outgoing.put))
+        assert (await asyncio.wait_for(outgoing.get(), 1))["type"] == "websocket.accept"
+
+        while not hub.subscribers:
+            await asyncio.sleep(0)
+        hub.publish({"id": "a", "timestamp": 1.0, "text": "hi"})
+        assert '"a"' in (await asyncio.wait_for(outgoing.get(), 1))["text"]
+        assert len(hub.subscribers) == 1
+
+        # nothing is published after the client leaves: only reading the socket can notice
+        await incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(handler, 1)
+        assert len(hub.subscribers) == 0
+
+    asyncio.run(test())